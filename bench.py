@@ -0,0 +1,409 @@
+"""
+Micro-benchmarks for the search engine.  Usage:
+
+  python3 bench.py [name ...]
+
+With no arguments every benchmark is run.
+"""
+
+import json, os, random, re, shutil, sqlite3, sys, tempfile, time
+from html.parser import HTMLParser
+
+from highlight import FindAndBoldTermsHTMLParser
+from merge import AtLeast, Intersect, ListSeeker, Union
+from query import BlockCursor, PostingCursor, ensure_indices
+from sqlindex import create_tables, pack_postings
+from utils import Hash64, MyHTMLParser, blake2b_hash64, get_tokens, sha256_hash64, text2tokens, thread_paths
+
+def make_postings_db(n, token_hash=1, seed=0):
+  # An in-memory "tokens" table with a single posting list of length n
+  # (plus some noise from another token so the index isn't trivial).
+  rng = random.Random(seed)
+  conn = sqlite3.connect(':memory:')
+  c = conn.cursor()
+  c.execute('CREATE TABLE tokens (token_hash INTEGER, comment_score INTEGER, comment_id INTEGER)')
+  rows = []
+  for i in range(n):
+    rows.append((token_hash, -rng.randint(0, 500), i))
+    rows.append((token_hash + 1, -rng.randint(0, 500), i))
+  c.executemany('INSERT INTO tokens VALUES (?, ?, ?)', rows)
+  ensure_indices(c)
+  conn.commit()
+  return c
+
+def bench_cursors(n=200_000, chunksize=1000):
+  c = make_postings_db(n)
+
+  print(f'cursors: per-chunk cost walking a {n}-posting list ({chunksize}/chunk)')
+  print(f'{"depth":>8} {"offset (ms)":>12} {"keyset (ms)":>12}')
+
+  # OFFSET paging, as token_iterator used to do it.
+  offset_times = []
+  offset = 0
+  while True:
+    t0 = time.time()
+    r = c.execute(f"""
+      SELECT comment_score, comment_id
+      FROM tokens
+      WHERE token_hash=1
+      ORDER BY comment_score, comment_id
+      LIMIT {chunksize}
+      OFFSET {offset}""").fetchall()
+    offset_times.append(time.time() - t0)
+    if len(r) < chunksize:
+      break
+    offset += len(r)
+
+  # Keyset paging with a fixed chunk size so the chunks line up.
+  keyset_times = []
+  cursor = PostingCursor(c, 'token_hash=?', (1,), chunksize=chunksize, maxchunksize=chunksize)
+  while not cursor.exhausted:
+    t0 = time.time()
+    cursor._fetch(cursor.chunk[-1] if len(cursor.chunk) > 0 else None)
+    keyset_times.append(time.time() - t0)
+
+  step = max(1, len(offset_times) // 10)
+  for i in range(0, min(len(offset_times), len(keyset_times)), step):
+    print(f'{i * chunksize:>8} {offset_times[i] * 1000:>12.3f} {keyset_times[i] * 1000:>12.3f}')
+  print(f'{"total":>8} {sum(offset_times) * 1000:>12.1f} {sum(keyset_times) * 1000:>12.1f}')
+
+  # Adaptive chunking: time to the first posting and for a full walk.
+  t0 = time.time()
+  cursor = PostingCursor(c, 'token_hash=?', (1,))
+  next(cursor)
+  first = time.time() - t0
+  n_walked = 1 + sum(1 for _ in cursor)
+  total = time.time() - t0
+  print(f'adaptive: first posting in {first * 1000:.3f}ms, {n_walked} postings in {total * 1000:.1f}ms ({cursor.num_fetches} fetches)')
+
+# The merge query.py used before merge.py, kept here for comparison.
+def scan_atleast(*iters, k=2):
+  try:
+    vals = [next(it) for it in iters]
+    while True:
+      minval = min(vals)
+      if sum([v == minval for v in vals]) >= k:
+        yield minval
+      for i in range(len(vals)):
+        if vals[i] == minval:
+          vals[i] = next(iters[i])
+  except StopIteration:
+    return
+
+def random_postings(rng, n, universe):
+  return sorted((-rng.randint(0, 500), i) for i in rng.sample(range(universe), n))
+
+def bench_merge(universe=1_000_000, seed=0):
+  rng = random.Random(seed)
+  lists = {
+    'rare': random_postings(rng, 100, universe),
+    'medium': random_postings(rng, 10_000, universe),
+    'common': random_postings(rng, 300_000, universe),
+    'common2': random_postings(rng, 300_000, universe),
+  }
+
+  cases = [
+    ('intersect rare medium common', ['rare', 'medium', 'common'], 3),
+    ('intersect common common2', ['common', 'common2'], 2),
+    ('atleast(2) rare medium common', ['rare', 'medium', 'common'], 2),
+    ('union rare medium', ['rare', 'medium'], 1),
+  ]
+
+  print(f'merge: synthetic posting lists ({", ".join(f"{k}={len(v)}" for k, v in lists.items())})')
+  print(f'{"case":<32} {"scan (ms)":>10} {"new (ms)":>10} {"results":>8}')
+  for name, keys, k in cases:
+    t0 = time.time()
+    old = list(scan_atleast(*[iter(lists[key]) for key in keys], k=k))
+    t_old = time.time() - t0
+
+    t0 = time.time()
+    seekers = [ListSeeker(lists[key]) for key in keys]
+    if k == len(keys):
+      new = list(Intersect(seekers))
+    elif k == 1:
+      new = list(Union(seekers))
+    else:
+      new = list(AtLeast(seekers, k=k))
+    t_new = time.time() - t0
+
+    # scan_atleast stops as soon as any list runs out, so it can only
+    # under-report unions.
+    assert old == new[:len(old)]
+    print(f'{name:<32} {t_old * 1000:>10.1f} {t_new * 1000:>10.1f} {len(new):>8}')
+
+# The highlighter server.py used before highlight.py, kept for comparison.
+class RegexPerTermHTMLParser(HTMLParser):
+  def __init__(self):
+    super().__init__()
+    self.terms = set()
+
+  def reset(self):
+    super().reset()
+    self.html = ''
+
+  def handle_starttag(self, tag, attrs):
+    r = '<' + tag
+    for key, value in attrs:
+      r += f' {key}="{value}"'
+    r += '>'
+    self.html += r
+
+  def handle_endtag(self, tag):
+    self.html += f'</{tag}>'
+
+  def handle_data(self, data):
+    for term in self.terms:
+      data = re.sub(
+        re.compile(f"[^\\w\\d]({term})[^\\w\\d]", re.IGNORECASE),
+        r" <span class='term'>\1</span> ",
+        data,
+      )
+      data = re.sub(
+        re.compile(f"^({term})[^\\w\\d]", re.IGNORECASE),
+        r"<span class='term'>\1</span> ",
+        data,
+      )
+    self.html += data
+
+# Reddit-style body_html built from the most common words in our comments.
+def random_body_html(rng, words, num_paragraphs):
+  paragraphs = []
+  for _ in range(num_paragraphs):
+    sentence = ' '.join(rng.choice(words) for _ in range(rng.randint(20, 80)))
+    if rng.random() < 0.3:
+      sentence += f' (see <a href="https://www.example.com/{rng.choice(words)}">{rng.choice(words)}</a>).'
+    if rng.random() < 0.2:
+      paragraphs.append(f'<blockquote>\n<p>{sentence}</p>\n</blockquote>')
+    else:
+      paragraphs.append(f'<p>{sentence.capitalize()}.</p>')
+  return '<div class="md">' + '\n'.join(paragraphs) + '\n</div>'
+
+def bench_highlight(num_comments=100, seed=0):
+  rng = random.Random(seed)
+  with open('bad.json', 'r') as f:
+    words = json.load(f)
+  comments = [random_body_html(rng, words, rng.randint(2, 12)) for _ in range(num_comments)]
+  print(f'highlight: {num_comments} comments, {sum(len(c) for c in comments) // 1000}kB of body_html')
+  print(f'{"terms":>6} {"per-term (ms)":>14} {"single-pass (ms)":>17}')
+  for num_terms in [1, 3, 6]:
+    terms = set(rng.sample(words, num_terms))
+
+    old = RegexPerTermHTMLParser()
+    old.terms = terms
+    t0 = time.time()
+    for html in comments:
+      old.reset()
+      old.feed(html)
+    t_old = time.time() - t0
+
+    t0 = time.time()
+    new = FindAndBoldTermsHTMLParser(terms)
+    for html in comments:
+      new.reset()
+      new.feed(html)
+    t_new = time.time() - t0
+
+    print(f'{num_terms:>6} {t_old * 1000:>14.1f} {t_new * 1000:>17.1f}')
+
+def bench_render(num_comments=100, seed=0):
+  rng = random.Random(seed)
+  with open('bad.json', 'r') as f:
+    words = json.load(f)
+  comments = [random_body_html(rng, words, rng.randint(2, 12)) for _ in range(num_comments)]
+  terms = set(rng.sample(words, 3))
+
+  # What build_index.py now does once per comment.
+  parser = MyHTMLParser()
+  rendered = []
+  for html in comments:
+    parser.reset()
+    parser.feed(html)
+    rendered.append(parser.alltext)
+
+  boulder = FindAndBoldTermsHTMLParser(terms)
+
+  t0 = time.time()
+  for html in comments:
+    parser.reset()
+    parser.feed(html)
+    boulder.reset()
+    boulder.feed(parser.alltext)
+  t_old = time.time() - t0
+
+  t0 = time.time()
+  for body in rendered:
+    boulder.reset()
+    boulder.feed(body)
+  t_new = time.time() - t0
+
+  print(f'render: {num_comments} results, parse+highlight {t_old * 1000:.1f}ms, highlight pre-rendered {t_new * 1000:.1f}ms')
+
+# The tokens an index build would hash for num_comments comments.
+def random_token_stream(rng, words, num_comments):
+  R = []
+  for _ in range(num_comments):
+    R += set(rng.choice(words) + rng.choice(['', 's', 'ing']) for _ in range(rng.randint(10, 80)))
+    R += [
+      f'year:{rng.randint(2018, 2022)}', f'month:{rng.randint(1, 12)}',
+      f'sub:{rng.choice(["themotte", "slatestarcodex"])}', f'score:{rng.randint(-5, 100)}',
+      f'author:user{rng.randint(0, 2000)}', f'depth:{rng.randint(0, 10)}',
+    ]
+  return R
+
+def bench_hash(num_comments=20000, seed=0):
+  rng = random.Random(seed)
+  with open('bad.json', 'r') as f:
+    words = json.load(f)
+  tokens = random_token_stream(rng, words, num_comments)
+  print(f'hash: {len(tokens)} tokens from {num_comments} comments')
+  for name, fn in [
+    ('sha256 (old)', sha256_hash64),
+    ('blake2b', blake2b_hash64),
+    ('blake2b + memo', Hash64('blake2b')),
+  ]:
+    t0 = time.time()
+    for token in tokens:
+      fn(token)
+    dt = time.time() - t0
+    print(f'{name:<16} {len(tokens) / dt:>12,.0f} tokens/sec')
+
+# The tokenizer utils.py used before the single findall pass.
+def old_text2tokens(text):
+  text = text.lower()
+  text = re.sub(r"[^\w\d%@#$^&']+", " ", text)
+  text = ' ' + text + ' '
+  text = text.replace(" '", " ")
+  text = text.replace("' ", " ")
+  tokens = set(text.strip().split(' '))
+  if '' in tokens:
+    tokens.remove('')
+  for token in ["a", "the", "to", "of", "and", "that", "is"]:
+    if token in tokens:
+      tokens.remove(token)
+  return tokens
+
+# (comment, thread) pairs from a sample of comments/, or synthetic comments
+# if there's no archive here.
+def sample_comments(rng, num_threads=50):
+  if os.path.exists('comments'):
+    paths = list(thread_paths())
+    R = []
+    for path in rng.sample(paths, min(num_threads, len(paths))):
+      with open(path, 'r') as f:
+        thread = json.load(f)
+      R += [(dict(c, depth=0), thread) for c in thread['comments'] if 'body_html' in c]
+    return R
+  with open('bad.json', 'r') as f:
+    words = json.load(f)
+  thread = {'url': 'culture_war_roundup', 'subreddit': 'TheMotte'}
+  return [({
+    'body_html': random_body_html(rng, words, rng.randint(1, 6)),
+    'author': f'user{rng.randint(0, 2000)}',
+    'created_utc': 1600000000 + rng.randint(0, 10**8),
+    'score': rng.randint(-5, 100),
+    'depth': rng.randint(0, 10),
+  }, thread) for _ in range(5000)]
+
+def bench_tokenize(seed=0):
+  rng = random.Random(seed)
+  comments = sample_comments(rng)
+  parser = MyHTMLParser()
+  texts = []
+  for comment, _ in comments:
+    parser.reset()
+    parser.feed(comment['body_html'])
+    texts.append(parser.text)
+
+  print(f'tokenize: {len(comments)} comments')
+  for name, fn in [('old text2tokens', old_text2tokens), ('text2tokens', text2tokens)]:
+    t0 = time.time()
+    n = sum(len(fn(text)) for text in texts)
+    dt = time.time() - t0
+    print(f'{name:<16} {n / dt:>12,.0f} tokens/sec')
+
+  t0 = time.time()
+  n = sum(len(get_tokens(comment, None, None, thread, isthread=False)) for comment, thread in comments)
+  dt = time.time() - t0
+  print(f'{"get_tokens":<16} {n / dt:>12,.0f} tokens/sec ({len(comments) / dt:,.0f} comments/sec)')
+
+def db_size(path):
+  conn = sqlite3.connect(path)
+  conn.execute('VACUUM')
+  page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+  page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+  conn.close()
+  return page_count * page_size
+
+def bench_blocks(num_comments=200_000, num_tokens=2000, seed=0):
+  rng = random.Random(seed)
+  tmpdir = tempfile.mkdtemp()
+  rows_path = os.path.join(tmpdir, 'rows.db')
+  blocks_path = os.path.join(tmpdir, 'blocks.db')
+
+  # Zipfian document frequencies; token 1 is in every other comment.
+  conn = sqlite3.connect(rows_path)
+  c = conn.cursor()
+  create_tables(c)
+  scores = [-rng.randint(-5, 500) for _ in range(num_comments)]
+  rows = []
+  for token in range(num_tokens):
+    n = num_comments // (2 * (token + 1))
+    for id_ in rng.sample(range(num_comments), n):
+      rows.append((token + 1, scores[id_], id_))
+  c.executemany('INSERT INTO tokens VALUES (?, ?, ?)', rows)
+  ensure_indices(c)
+  conn.commit()
+  conn.close()
+
+  with open(rows_path, 'rb') as src, open(blocks_path, 'wb') as dst:
+    dst.write(src.read())
+  conn = sqlite3.connect(blocks_path)
+  pack_postings(conn.cursor())
+  conn.commit()
+  conn.close()
+
+  print(f'blocks: {len(rows)} postings, {num_tokens} tokens')
+  print(f'{"":<24} {"rows":>12} {"blocks":>12}')
+  sizes = [db_size(rows_path), db_size(blocks_path)]
+  print(f'{"index size (MB)":<24} {sizes[0] / 1e6:>12.1f} {sizes[1] / 1e6:>12.1f}')
+  print(f'{"bytes/posting":<24} {sizes[0] / len(rows):>12.1f} {sizes[1] / len(rows):>12.1f}')
+
+  cursors = [
+    lambda c, t: PostingCursor(c, 'token_hash=?', (t,)),
+    lambda c, t: BlockCursor(c, t),
+  ]
+  conns = [sqlite3.connect(rows_path).cursor(), sqlite3.connect(blocks_path).cursor()]
+
+  times = []
+  for c, make in zip(conns, cursors):
+    t0 = time.time()
+    n = sum(1 for _ in make(c, 1))
+    times.append(n / (time.time() - t0))
+  print(f'{"scan (postings/sec)":<24} {times[0]:>12,.0f} {times[1]:>12,.0f}')
+
+  for rare in [500, 50]:
+    times = []
+    for c, make in zip(conns, cursors):
+      t0 = time.time()
+      n = len(list(Intersect([make(c, rare), make(c, 2), make(c, 1)])))
+      times.append((time.time() - t0) * 1000)
+    print(f'{f"intersect {rare} 2 1 (ms)":<24} {times[0]:>12.1f} {times[1]:>12.1f}')
+
+  for c in conns:
+    c.connection.close()
+  shutil.rmtree(tmpdir)
+
+kBenchmarks = {
+  'cursors': bench_cursors,
+  'merge': bench_merge,
+  'highlight': bench_highlight,
+  'render': bench_render,
+  'hash': bench_hash,
+  'tokenize': bench_tokenize,
+  'blocks': bench_blocks,
+}
+
+if __name__ == '__main__':
+  names = sys.argv[1:] if len(sys.argv) > 1 else list(kBenchmarks)
+  for name in names:
+    kBenchmarks[name]()
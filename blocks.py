@@ -0,0 +1,66 @@
+"""
+Compact posting-list storage.
+
+A token's postings are split into blocks of kBlockSize consecutive
+(comment_score, comment_id) postings.  Within a block each posting is
+stored as the difference from the previous one (the first from (0, 0)),
+both fields zigzag-encoded and written as little-endian base-128 varints.
+Postings are sorted, so most score deltas are 0 and fit in a single byte.
+
+Each block is stored alongside its last posting, which serves as the skip
+pointer: the first block whose last posting is >= target is the only block
+that can contain target, so seeking costs one index lookup plus decoding
+one block.
+"""
+
+from itertools import accumulate
+
+kBlockSize = 128
+
+def zigzag(x):
+  return x << 1 if x >= 0 else ((-x) << 1) - 1
+
+def encode_varints(values, out):
+  for x in values:
+    while x >= 0x80:
+      out.append((x & 0x7f) | 0x80)
+      x >>= 7
+    out.append(x)
+
+def decode_varints(data):
+  R = []
+  x = shift = 0
+  for b in data:
+    if b < 0x80:
+      R.append(x | (b << shift))
+      x = shift = 0
+    else:
+      x |= (b & 0x7f) << shift
+      shift += 7
+  return R
+
+def encode_block(postings):
+  values = []
+  prev_score = prev_id = 0
+  for score, id_ in postings:
+    values.append(zigzag(score - prev_score))
+    values.append(zigzag(id_ - prev_id))
+    prev_score, prev_id = score, id_
+  out = bytearray()
+  encode_varints(values, out)
+  return bytes(out)
+
+def decode_block(data):
+  values = [(x >> 1) ^ -(x & 1) for x in decode_varints(data)]
+  return list(zip(accumulate(values[0::2]), accumulate(values[1::2])))
+
+# Splits a sorted posting list into (last_posting, data) blocks.
+def encode_blocks(postings, block_size=kBlockSize):
+  R = []
+  for i in range(0, len(postings), block_size):
+    block = postings[i:i + block_size]
+    R.append((block[-1], encode_block(block)))
+  return R
+
+assert decode_block(encode_block([(-5, 10), (-5, 12), (0, 3), (7, 1 << 40)])) == [(-5, 10), (-5, 12), (0, 3), (7, 1 << 40)]
+assert decode_block(b'') == []
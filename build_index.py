@@ -1,31 +1,25 @@
 from utils import *
 
 import spot
+from sqlindex import SqlIndex, build_time_order, comment_version, file_sha1
 
-import time
+import multiprocessing, time
 
-if os.path.exists('spot-index'):
-  os.remove('spot-index')
+"""
+Parsing and tokenizing is done by a pool of worker processes, one thread
+file at a time; a single writer (this process) inserts the results in file
+order, so the index is identical to the one a serial build produces.
+"""
 
-index = spot.Index.create('spot-index', rankings=['score'], ranges=['created_utc'])
-
-comment_insertions = 0
-token_insertions = 0
-
-lasttime = time.time()
-
-ids = set()
-allscores = []
-for thread in threads(years=['2020']):
+# Returns [(id_, tokens, comment)] for every indexable comment in a thread.
+def process_thread(path):
+  with open(path, 'r') as f:
+    thread = json.load(f)
   comments = thread['comments']
 
-  if comment_insertions > 20000:
-    break
-
-  id2comment = {}
-  for comment in comments:
-    id2comment[comment['id']] = comment
+  tree = ThreadTree(comments)
 
+  R = []
   for comment in comments:
     if 'body_html' not in comment:
       continue
@@ -34,45 +28,155 @@ for thread in threads(years=['2020']):
     if comment['body_html'] == '<div class="md"><p>[deleted]</p>\n</div>':
       continue
 
-    depth = 0
-    parent = id2comment.get(comment['parent_id'][3:], None)
-    if parent:
-      depth += 1
-      gparent = id2comment.get(parent['parent_id'][3:], None)
-      ancestor = gparent
-      while ancestor and (ancestor['parent_id'][3:] in id2comment):
-        depth += 1
-        ancestor = id2comment.get(ancestor['parent_id'][3:], None)
-    else:
-      gparent = None
-
-    comment['depth'] = depth
+    parent = tree.get_parent(comment['id'])
+    gparent = tree.get_gparent(comment['id'])
+    comment['depth'] = tree.depth.get(comment['id'], 0)
+    comment['num_descendants'] = tree.subtree_size.get(comment['id'], 1) - 1
 
     tokens = get_tokens(comment, parent, gparent, thread, isthread=False)
-    comment['tokens'] = ' '.join(tokens)
+    # Sorted so the stored string doesn't depend on the worker's hash seed.
+    comment['tokens'] = ' '.join(sorted(tokens))
+    comment.update(display_fields(comment, parent, thread, parser.alltext))
 
-    # Save some space -- all this information is in body_html anyway
+    # Save some space -- all this information is in body_html anyway (and
+    # the server only needs the pre-rendered body).
     del comment['body']
+    del comment['body_html']
 
     if 'score' not in comment:
       comment['score'] = comment.get('ups', 0)
 
-    id_ = int(comment['id'], 36)
-    if id_ in ids:
-      continue
-    ids.add(id_)
-
-    index.insert(id_, tokens, comment)
-    comment_insertions += 1
-    token_insertions += len(tokens)
-
-    if comment_insertions % 10000 == 0:
-    	print('%.3f' % (time.time() - lasttime), comment_insertions, token_insertions)
-    	lasttime = time.time()
-
-index.create_indices()
+    R.append((int(comment['id'], 36), tokens, comment))
 
-index.commit()
+  return R
 
-print(comment_insertions, 'comments inserted')
-print(token_insertions, 'tokens inserted')
+# Returns the thread files that changed since they were last indexed, as
+# (path, mtime, size, sha1).  Files whose mtime changed but whose contents
+# didn't are just re-stamped in the manifest.
+def changed_files(index, paths):
+  known = index.files()
+  R = []
+  for path in paths:
+    st = os.stat(path)
+    entry = known.get(path)
+    if entry is not None and entry[:2] == (st.st_mtime, st.st_size):
+      continue
+    sha1 = file_sha1(path)
+    if entry is not None and entry[2] == sha1:
+      index.set_file(path, st.st_mtime, st.st_size, sha1)
+      continue
+    R.append((path, st.st_mtime, st.st_size, sha1))
+  return R
+
+if __name__ == '__main__':
+  argparser = argparse.ArgumentParser()
+  argparser.add_argument('--workers', type=int, default=os.cpu_count(), help='parsing processes (1 builds serially)')
+  argparser.add_argument('--years', nargs='*', help='only index these years')
+  argparser.add_argument('--limit', type=int, default=None, help='stop after (about) this many comments')
+  argparser.add_argument('--sqlite', metavar='PATH', help='build the sqlite index query.py searches (e.g. new.db) instead of spot-index')
+  argparser.add_argument('--incremental', action='store_true', help='only reindex threads that changed since the last build (requires --sqlite)')
+  argparser.add_argument('--pack', action='store_true', help='store postings as compressed blocks (requires --sqlite)')
+  argparser.add_argument('--time-order', action='store_true', help='also index postings by time, for newest/oldest-first results (requires --sqlite)')
+  args = argparser.parse_args()
+
+  if args.incremental and args.sqlite is None:
+    argparser.error('--incremental requires --sqlite')
+  if args.pack and args.sqlite is None:
+    argparser.error('--pack requires --sqlite')
+  if args.time_order and args.sqlite is None:
+    argparser.error('--time-order requires --sqlite')
+
+  if args.sqlite is None:
+    if os.path.exists('spot-index'):
+      os.remove('spot-index')
+    index = spot.Index.create('spot-index', rankings=['score'], ranges=['created_utc'])
+  elif args.incremental:
+    index = SqlIndex(args.sqlite)
+  else:
+    index = SqlIndex.create(args.sqlite)
+  if args.pack:
+    index.packed = True
+
+  comment_insertions = 0
+  comment_deletions = 0
+  token_insertions = 0
+
+  starttime = time.time()
+  lasttime = starttime
+  lastcount = 0
+
+  paths = list(thread_paths(args.years))
+  if args.sqlite is not None:
+    files = changed_files(index, paths)
+    # Threads that have disappeared from disk (only knowable when we've
+    # looked at every year).
+    if args.years is None:
+      for path in set(index.files()) - set(paths):
+        comment_deletions += len(index.comments_in(path))
+        index.remove_file(path)
+    paths = [f[0] for f in files]
+    print(len(paths), 'thread files to index')
+
+  if args.workers > 1:
+    pool = multiprocessing.Pool(args.workers)
+    results = pool.imap(process_thread, paths, chunksize=4)
+  else:
+    pool = None
+    results = map(process_thread, paths)
+
+  ids = set()
+  for i, batch in enumerate(results):
+    if args.limit is not None and comment_insertions > args.limit:
+      break
+
+    if args.sqlite is None:
+      for id_, tokens, comment in batch:
+        if id_ in ids:
+          continue
+        ids.add(id_)
+        index.insert(id_, tokens, comment)
+        comment_insertions += 1
+        token_insertions += len(tokens)
+    else:
+      # Upsert the comments whose indexed form changed; whatever is left
+      # in `stale` has disappeared from the thread (e.g. been deleted).
+      path, mtime, size, sha1 = files[i]
+      stale = index.comments_in(path)
+      for id_, tokens, comment in batch:
+        version = comment_version(comment)
+        if id_ in stale:
+          if stale.pop(id_) == version:
+            continue
+          index.delete(id_)
+          comment_deletions += 1
+        elif index.owner(id_) is not None:
+          # Already indexed from another thread file.
+          continue
+        index.insert(id_, tokens, comment, path=path, version=version)
+        comment_insertions += 1
+        token_insertions += len(tokens)
+      for id_ in stale:
+        index.delete(id_)
+        comment_deletions += 1
+      index.set_file(path, mtime, size, sha1)
+
+    if comment_insertions - lastcount >= 10000:
+      now = time.time()
+      print('%.3f' % (now - lasttime), comment_insertions, token_insertions, '%.0f comments/sec' % ((comment_insertions - lastcount) / (now - lasttime)))
+      lasttime = now
+      lastcount = comment_insertions
+
+  if pool is not None:
+    pool.terminate()
+
+  index.create_indices()
+  if args.time_order and not index.time_order:
+    build_time_order(index.c)
+
+  index.commit()
+
+  print(comment_insertions, 'comments inserted')
+  if args.sqlite is not None:
+    print(comment_deletions, 'comments removed')
+  print(token_insertions, 'tokens inserted')
+  print('%.0f comments/sec overall' % (comment_insertions / max(time.time() - starttime, 1e-9)))
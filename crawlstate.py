@@ -0,0 +1,109 @@
+"""
+What refresh.py knows about each submission from previous runs, so a
+refresh only crawls the threads that have changed.
+
+The /r/<sub>/new listing we fetch anyway reports every submission's
+num_comments, so a thread whose count hasn't moved since its last crawl can
+usually be skipped outright.  Unchanged threads are still given a shallow
+refresh (one listing request, which updates the scores of the comments it
+shows) now and then, less often the longer the thread has been quiet:
+every kRefreshFraction of the time since its last activity, clamped to
+[kMinRefreshInterval, kMaxRefreshInterval].
+
+It also holds the crawl's work queue: submissions are enqueued as soon as
+they're listed and only leave the queue when their crawl is recorded, so
+whatever a crashed (or interrupted) run didn't finish is picked up by the
+next one.
+"""
+
+import json, sqlite3, time
+
+kMinRefreshInterval = 60 * 60            # 1 hour
+kMaxRefreshInterval = 60 * 60 * 24 * 7   # 1 week
+kRefreshFraction = 0.25
+
+# What to do with a submission.
+kSkip = 'skip'
+kShallow = 'shallow'  # Fetch the listing only; don't expand "more" stubs.
+kFull = 'full'
+
+class CrawlState:
+  def __init__(self, path):
+    self.conn = sqlite3.connect(path)
+    self.conn.execute("""
+      CREATE TABLE IF NOT EXISTS submissions (
+        id TEXT PRIMARY KEY,
+        subreddit TEXT,
+        created_utc REAL,
+        num_comments INTEGER,
+        newest_comment_utc REAL,
+        last_crawl REAL
+      )""")
+    self.conn.execute("""
+      CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        json TEXT
+      )""")
+    self.conn.commit()
+
+  # Returns the stored row as a dict, or None.
+  def get(self, id_):
+    row = self.conn.execute("""
+      SELECT subreddit, created_utc, num_comments, newest_comment_utc, last_crawl
+      FROM submissions WHERE id = ?""", (id_,)).fetchone()
+    if row is None:
+      return None
+    return dict(zip(['subreddit', 'created_utc', 'num_comments', 'newest_comment_utc', 'last_crawl'], row))
+
+  # How long an unchanged thread, last active at `last_active`, can go
+  # between refreshes.
+  def refresh_interval(self, last_active, now):
+    interval = (now - last_active) * kRefreshFraction
+    return min(kMaxRefreshInterval, max(kMinRefreshInterval, interval))
+
+  # `submission` is a listing entry (from Reddit.new_submissions).
+  def action(self, submission, now=None):
+    if now is None:
+      now = time.time()
+    state = self.get(submission['id'])
+    if state is None or state['num_comments'] != submission['num_comments']:
+      return kFull
+    last_active = max(state['created_utc'], state['newest_comment_utc'] or 0)
+    if now - state['last_crawl'] >= self.refresh_interval(last_active, now):
+      return kShallow
+    return kSkip
+
+  # Adds listing entries to the work queue (replacing older entries for the
+  # same submissions).
+  def enqueue(self, submissions):
+    self.conn.executemany("INSERT OR REPLACE INTO jobs (id, json) VALUES (?, ?)", [
+      (s['id'], json.dumps(s)) for s in submissions
+    ])
+    self.conn.commit()
+
+  # The listing entries of every unfinished job.
+  def jobs(self):
+    return [json.loads(row[0]) for row in self.conn.execute("SELECT json FROM jobs ORDER BY rowid")]
+
+  def dequeue(self, id_):
+    self.conn.execute("DELETE FROM jobs WHERE id = ?", (id_,))
+    self.conn.commit()
+
+  # Records a crawl of `submission` and removes it from the work queue.
+  def record(self, submission, newest_comment_utc, now=None):
+    if now is None:
+      now = time.time()
+    self.conn.execute("""
+      INSERT OR REPLACE INTO submissions
+      (id, subreddit, created_utc, num_comments, newest_comment_utc, last_crawl)
+      VALUES (?, ?, ?, ?, ?, ?)""", (
+        submission['id'],
+        submission['subreddit'],
+        submission['created_utc'],
+        submission['num_comments'],
+        newest_comment_utc,
+        now,
+      ))
+    self.conn.execute("DELETE FROM jobs WHERE id = ?", (submission['id'],))
+    self.conn.commit()
+
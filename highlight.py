@@ -0,0 +1,50 @@
+import re
+from html.parser import HTMLParser
+
+"""
+Wraps query terms in <span class='term'>.
+
+All the terms of a query are compiled into a single alternation once per
+query, so each text node is highlighted in one pass.  A term only matches
+as a whole word: it must not be preceded by a word character and must be
+followed by a non-word character.
+"""
+class TermHighlighter:
+  def __init__(self, terms):
+    # Longest first, so "foobar" wins over "foo" when both are terms.
+    terms = sorted(set(terms), key=lambda t: (-len(t), t))
+    if len(terms) == 0:
+      self.pattern = None
+    else:
+      self.pattern = re.compile(
+        r"(?<!\w)(" + '|'.join(re.escape(t) for t in terms) + r")(?=[^\w])",
+        re.IGNORECASE,
+      )
+
+  def highlight(self, text):
+    if self.pattern is None:
+      return text
+    return self.pattern.sub(r"<span class='term'>\1</span>", text)
+
+class FindAndBoldTermsHTMLParser(HTMLParser):
+  def __init__(self, terms=()):
+    super().__init__()
+    self.highlighter = TermHighlighter(terms)
+
+  def reset(self):
+    super().reset()
+    self.parts = []
+
+  @property
+  def html(self):
+    return ''.join(self.parts)
+
+  def handle_starttag(self, tag, attrs):
+    self.parts.append('<' + tag + ''.join(f' {key}="{value}"' for key, value in attrs) + '>')
+
+  def handle_endtag(self, tag):
+    self.parts.append(f'</{tag}>')
+
+  def handle_data(self, data):
+    # self.parts.append(cgi.escape(data))
+    self.parts.append(self.highlighter.highlight(data))
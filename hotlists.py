@@ -0,0 +1,115 @@
+"""
+Hot posting lists: the complete posting lists of an index's most frequent
+tokens (year:, sub:, common words), stored uncompressed next to the index
+(new.db -> new.db.hot) so they can be memory-mapped and searched in place.
+
+File layout: an 8-byte header length, a JSON header, padding to a multiple
+of 8 bytes, then every list as consecutive native-endian int64
+(comment_score, comment_id) pairs.  The header maps each token_hash to the
+offset (in pairs) and length of its list.
+
+Loading maps the file and casts it to int64 without copying anything, so
+a list costs nothing until it's touched, and seek() / membership tests are
+binary searches over the mapped pages rather than sqlite queries.
+
+The header also records the index version (sqlindex.index_version) the
+lists were built from, so readers can tell when the index has moved on
+without them.
+"""
+
+import array, json, mmap, os, struct, sys, threading
+
+kHotListSize = 100  # Default number of tokens to keep.
+
+def hot_path(db_path):
+  return db_path + '.hot'
+
+# `lists` yields (token_hash, postings) with each posting list sorted;
+# `version` is the version of the index they were read from.
+def write_hot_lists(path, lists, top, version):
+  values = array.array('q')
+  header = {'byteorder': sys.byteorder, 'top': top, 'version': version, 'lists': {}}
+  for token_hash, postings in lists:
+    header['lists'][str(token_hash)] = [len(values) // 2, len(postings)]
+    for score, id_ in postings:
+      values.append(score)
+      values.append(id_)
+  header = json.dumps(header).encode()
+  header += b' ' * (-(8 + len(header)) % 8)
+  tmp = path + '.tmp'
+  with open(tmp, 'wb') as f:
+    f.write(struct.pack('<q', len(header)))
+    f.write(header)
+    values.tofile(f)
+  os.replace(tmp, path)
+
+"""
+Read-only sequence view of one mapped posting list.  It supports len() and
+integer indexing, which is all bisect, merge.gallop and merge.ListSeeker
+need.
+"""
+class PostingArray:
+  def __init__(self, values, start, n):
+    self.values = values
+    self.start = start
+    self.n = n
+
+  def __len__(self):
+    return self.n
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += self.n
+    if not 0 <= i < self.n:
+      raise IndexError(i)
+    j = 2 * (self.start + i)
+    return (self.values[j], self.values[j + 1])
+
+class HotLists:
+  def __init__(self, path):
+    with open(path, 'rb') as f:
+      self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header_len = struct.unpack_from('<q', self.mm, 0)[0]
+    header = json.loads(self.mm[8:8 + header_len])
+    if header['byteorder'] != sys.byteorder:
+      raise ValueError(f'{path} was written on a {header["byteorder"]}-endian machine')
+    self.top = header['top']
+    self.version = header.get('version')
+    self.values = memoryview(self.mm)[8 + header_len:].cast('q')
+    self.lists = {int(h): tuple(v) for h, v in header['lists'].items()}
+
+  def __len__(self):
+    return len(self.lists)
+
+  def __contains__(self, token_hash):
+    return token_hash in self.lists
+
+  # Returns the token's PostingArray, or None if it isn't hot.
+  def get(self, token_hash):
+    entry = self.lists.get(token_hash)
+    if entry is None:
+      return None
+    return PostingArray(self.values, *entry)
+
+  def num_postings(self):
+    return len(self.values) // 2
+
+loaded = {}  # path -> ((inode, mtime, size), HotLists)
+loaded_lock = threading.Lock()
+
+# Maps the hot lists at `path`, or returns None if there aren't any.  The
+# mapping is reused until the file is replaced or removed.
+def load_hot_lists(path):
+  path = os.path.abspath(path)
+  try:
+    st = os.stat(path)
+  except FileNotFoundError:
+    with loaded_lock:
+      loaded.pop(path, None)
+    return None
+  key = (st.st_ino, st.st_mtime_ns, st.st_size)
+  with loaded_lock:
+    entry = loaded.get(path)
+    if entry is None or entry[0] != key:
+      entry = loaded[path] = (key, HotLists(path))
+    return entry[1]
@@ -0,0 +1,181 @@
+"""
+Merge operators over sorted posting lists.
+
+Every posting list is an iterator of postings in ascending order.  On top of
+the iterator protocol the operators here understand `seek(target)`, which
+consumes and returns the first remaining posting >= target (raising
+StopIteration if there isn't one).  Operators are themselves seekable, so a
+query tree of intersections/unions can skip whole runs of postings instead
+of stepping through them one by one.
+
+Plain iterators/generators work too -- they are wrapped so that seek()
+falls back to stepping.
+"""
+
+import bisect, heapq
+
+# Historically iterators yielded this when they hit their limit.  It sorts
+# before every real posting, so the merge operators treat it as the end of
+# the list.
+kMaxVal = (float('-inf'), 0)
+
+# Returns the first index >= lo such that a[index] >= target, probing
+# lo+1, lo+2, lo+4, ... before binary searching the last gap.  This costs
+# O(log d) where d is the distance skipped, rather than O(log len(a)).
+def gallop(a, target, lo=0):
+  n = len(a)
+  if lo >= n or a[lo] >= target:
+    return lo
+  step = 1
+  hi = lo + 1
+  while hi < n and a[hi] < target:
+    lo = hi
+    step *= 2
+    hi = lo + step
+  return bisect.bisect_left(a, target, lo + 1, min(hi, n))
+
+class Seekable:
+  def __iter__(self):
+    return self
+
+  def seek(self, target):
+    r = next(self)
+    while r < target:
+      r = next(self)
+    return r
+
+class IterSeeker(Seekable):
+  def __init__(self, it):
+    self.it = iter(it)
+
+  def __next__(self):
+    r = next(self.it)
+    if r == kMaxVal:
+      raise StopIteration
+    return r
+
+class ListSeeker(Seekable):
+  def __init__(self, postings):
+    self.postings = postings
+    self.i = 0
+
+  def __next__(self):
+    if self.i >= len(self.postings):
+      raise StopIteration
+    self.i += 1
+    return self.postings[self.i - 1]
+
+  def seek(self, target):
+    self.i = gallop(self.postings, target, self.i)
+    return next(self)
+
+def seekable(it):
+  if isinstance(it, Seekable):
+    return it
+  if isinstance(it, list):
+    return ListSeeker(it)
+  return IterSeeker(it)
+
+class Limited(Seekable):
+  def __init__(self, limit):
+    self.limit = limit
+    self.num_returned = 0
+
+  def _count(self, r):
+    self.num_returned += 1
+    return r
+
+  def _check_limit(self):
+    if self.num_returned >= self.limit:
+      raise StopIteration
+
+"""
+Heap-ordered union: O(log k) per posting for k inputs.
+"""
+class Union(Limited):
+  def __init__(self, iters, limit=float('inf')):
+    super().__init__(limit)
+    self.iters = [seekable(it) for it in iters]
+    self.heap = []
+    for i, it in enumerate(self.iters):
+      try:
+        self.heap.append((next(it), i))
+      except StopIteration:
+        pass
+    heapq.heapify(self.heap)
+
+  def _advance_head(self, r):
+    i = self.heap[0][1]
+    try:
+      heapq.heapreplace(self.heap, (r(self.iters[i]), i))
+    except StopIteration:
+      heapq.heappop(self.heap)
+
+  def __next__(self):
+    self._check_limit()
+    if len(self.heap) == 0:
+      raise StopIteration
+    v = self.heap[0][0]
+    while len(self.heap) > 0 and self.heap[0][0] == v:
+      self._advance_head(next)
+    return self._count(v)
+
+  def seek(self, target):
+    while len(self.heap) > 0 and self.heap[0][0] < target:
+      self._advance_head(lambda it: it.seek(target))
+    return next(self)
+
+"""
+Leapfrog intersection: each input in turn seeks to the largest posting seen
+so far until they all agree.  Rare inputs make the common ones skip.
+"""
+class Intersect(Limited):
+  def __init__(self, iters, limit=float('inf')):
+    super().__init__(limit)
+    self.iters = [seekable(it) for it in iters]
+
+  # v was just taken from iters[0]; find the first posting >= v in all inputs.
+  def _align(self, v):
+    n = len(self.iters)
+    agree = 1
+    i = 1 % n
+    while agree < n:
+      x = self.iters[i].seek(v)
+      if x == v:
+        agree += 1
+      else:
+        v = x
+        agree = 1
+      i = (i + 1) % n
+    return v
+
+  def __next__(self):
+    self._check_limit()
+    return self._count(self._align(next(self.iters[0])))
+
+  def seek(self, target):
+    self._check_limit()
+    return self._count(self._align(self.iters[0].seek(target)))
+
+"""
+Threshold merge for "in at least k of the inputs".  No posting smaller than
+the k-th smallest head can be in k lists, so every input behind it seeks
+straight there.
+"""
+class AtLeast(Union):
+  def __init__(self, iters, k=2, limit=float('inf')):
+    assert 1 <= k <= len(iters)
+    super().__init__(iters, limit)
+    self.k = k
+
+  def __next__(self):
+    self._check_limit()
+    while len(self.heap) >= self.k:
+      pivot = heapq.nsmallest(self.k, self.heap)[-1][0]
+      if self.heap[0][0] == pivot:
+        while len(self.heap) > 0 and self.heap[0][0] == pivot:
+          self._advance_head(next)
+        return self._count(pivot)
+      while self.heap[0][0] < pivot:
+        self._advance_head(lambda it: it.seek(pivot))
+    raise StopIteration
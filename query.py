@@ -1,104 +1,324 @@
 from utils import *
 from expression_parser import query_to_tree
 
+from merge import Seekable, Intersect, Union, AtLeast, ListSeeker, gallop, seekable, kMaxVal
+from datetime import timedelta
+from sqlindex import ensure_attributes, ensure_indices, ensure_token_stats, has_time_order, index_hashfn, index_path, index_version, index_hot_lists, index_posting_format
+from blocks import decode_block
+
+from collections import OrderedDict
 from urllib.parse import urlparse
-import time
+import base64, bisect, threading, time
 
-kMaxVal = (float('-inf'), 0)
 kDefaultLimit = 1000
-kDefaultChunkSize = 1000
+kFirstChunkSize = 64
+kMaxChunkSize = 8192
+kFirstBlockChunkSize = 1
+kMaxBlockChunkSize = 64
+kCommentCacheSize = 10000
+kResultCacheSize = 1000  # Queries.
+kResultCacheMaxPostings = 1000000
+kResultCacheTTL = 600  # Seconds.
+kBatchSizes = [5, 25, 100]
+
+# sqlite's default SQLITE_MAX_VARIABLE_NUMBER is 999 on older builds.
+kMaxSqlParams = 900
 
-class Hash64:
-  def __init__(self):
-    pass
-  def __call__(self, x):
-    h = hashlib.sha256()
-    h.update(x.encode())
-    return int(h.hexdigest()[-16:], 16)
-hashfn = Hash64()
 
 def intersect(*iters, limit=kDefaultLimit):
-  return atleast(*iters, k=len(iters), limit=limit)
+  return Intersect(iters, limit=limit)
 
 def union(*iters, limit=kDefaultLimit):
-  return atleast(*iters, k=1, limit=limit)
+  return Union(iters, limit=limit)
 
 def atleast(*iters, k=2, limit=kDefaultLimit):
-  assert 1 <= k <= len(iters)
+  return AtLeast(iters, k=k, limit=limit)
 
-  num_returned = 0
-  try:
-    vals = [next(it) for it in iters]
-    while True:
-      minval = min(vals)
-      if sum([v == minval for v in vals]) >= k:
-        yield minval
-        num_returned += 1
-        if num_returned >= limit:
-          break
-
-      for i in range(len(vals)):
-        if vals[i] == minval:
-          vals[i] = next(iters[i])
+"""
+Walks the (comment_score, comment_id) postings that satisfy `where` in
+ascending order.
 
-  except StopIteration:
-    return
+Rather than paging with OFFSET (which makes sqlite re-scan every row before
+the requested page) we remember the last posting of the previous chunk and
+ask for the rows after it, which the covering index answers with a single
+seek.  The first chunk is small so the first results come back quickly;
+every subsequent chunk doubles (up to maxchunksize) so deep scans make few
+round trips.
+"""
+class PostingCursor(Seekable):
+  def __init__(self, sql_cursor, where, params=(), chunksize=kFirstChunkSize, maxchunksize=kMaxChunkSize, table='tokens', key='comment_score', sign=1):
+    self.sql_cursor = sql_cursor
+    self.table = table
+    # Postings are (key, comment_id), or (-key, -comment_id) walking the
+    # table backwards (sign=-1).
+    self.key = key
+    self.sign = sign
+    self.where = where
+    self.params = tuple(params)
+    self.chunksize = chunksize
+    self.maxchunksize = maxchunksize
+    self.chunk = []
+    self.i = 0
+    self.exhausted = False
+    self.num_fetches = 0
+
+  # Fetches the next chunk of postings after `after` (or starting at it, if
+  # inclusive).
+  def _fetch(self, after=None, inclusive=False):
+    if self.sign > 0:
+      columns = f'{self.key}, comment_id'
+      order = f'{self.key}, comment_id'
+      cmp = '>'
+    else:
+      columns = f'-{self.key}, -comment_id'
+      order = f'{self.key} DESC, comment_id DESC'
+      cmp = '<'
+    if after is None:
+      sql = f"""
+        SELECT {columns}
+        FROM {self.table}
+        WHERE {self.where}
+        ORDER BY {order}
+        LIMIT ?"""
+      args = self.params + (self.chunksize,)
+    else:
+      sql = f"""
+        SELECT {columns}
+        FROM {self.table}
+        WHERE {self.where}
+        AND ({self.key}, comment_id) {cmp + '=' if inclusive else cmp} (?, ?)
+        ORDER BY {order}
+        LIMIT ?"""
+      args = self.params + tuple(self.sign * x for x in after) + (self.chunksize,)
+    self.chunk = self.sql_cursor.execute(sql, args).fetchall()
+    self.i = 0
+    self.num_fetches += 1
+    if len(self.chunk) < self.chunksize:
+      self.exhausted = True
+    self.chunksize = min(self.chunksize * 2, self.maxchunksize)
+
+  def __next__(self):
+    if self.i >= len(self.chunk):
+      if self.exhausted:
+        raise StopIteration
+      self._fetch(self.chunk[-1] if len(self.chunk) > 0 else None)
+      if self.i >= len(self.chunk):
+        raise StopIteration
+    self.i += 1
+    return self.chunk[self.i - 1]
+
+  def seek(self, target):
+    if len(self.chunk) > 0 and self.chunk[-1] >= target:
+      self.i = gallop(self.chunk, target, self.i)
+    elif not self.exhausted:
+      # The target is past everything we've fetched; jump straight to it.
+      self._fetch(target, inclusive=True)
+    else:
+      self.i = len(self.chunk)
+    return next(self)
+
+"""
+PostingCursor for a packed index: walks the (comment_score, comment_id)
+postings of one token in [lo, hi) by decoding its blocks in order.
+
+Blocks are fetched in chunks that double in size, like PostingCursor's
+rows, and only decoded when the walk reaches them.  seek() uses the skip
+pointers (each block's last posting) to jump over whole blocks without
+decoding them: first among the blocks already fetched, then with a single
+index seek in sqlite.
+"""
+class BlockCursor(Seekable):
+  def __init__(self, sql_cursor, token_hash, lo=None, hi=None, chunksize=kFirstBlockChunkSize, maxchunksize=kMaxBlockChunkSize):
+    self.sql_cursor = sql_cursor
+    self.token_hash = token_hash
+    self.lo = lo
+    self.hi = hi
+    self.chunksize = chunksize
+    self.maxchunksize = maxchunksize
+    self.lasts = []  # The last posting of each fetched block...
+    self.datas = []  # ...and its encoded postings.
+    self.j = 0  # The next fetched block to decode.
+    self.block = []
+    self.i = 0
+    self.exhausted = False
+    self.started = False
+    self.num_fetches = 0
+    self.num_decoded = 0
+
+  # Fetches the next chunk of blocks whose last posting is after `after`
+  # (or >= it, if inclusive).
+  def _fetch(self, after=None, inclusive=False):
+    if after is None:
+      rows = self.sql_cursor.execute("""
+        SELECT last_score, last_id, data
+        FROM posting_blocks
+        WHERE token_hash=?
+        ORDER BY last_score, last_id
+        LIMIT ?""", (self.token_hash, self.chunksize)).fetchall()
+    else:
+      rows = self.sql_cursor.execute(f"""
+        SELECT last_score, last_id, data
+        FROM posting_blocks
+        WHERE token_hash=?
+        AND (last_score, last_id) {'>=' if inclusive else '>'} (?, ?)
+        ORDER BY last_score, last_id
+        LIMIT ?""", (self.token_hash,) + tuple(after) + (self.chunksize,)).fetchall()
+    self.lasts = [(r[0], r[1]) for r in rows]
+    self.datas = [r[2] for r in rows]
+    self.j = 0
+    self.num_fetches += 1
+    if len(rows) < self.chunksize:
+      self.exhausted = True
+    self.chunksize = min(self.chunksize * 2, self.maxchunksize)
+
+  # Decodes fetched block j.
+  def _decode(self, j):
+    self.block = decode_block(self.datas[j])
+    self.i = 0
+    self.j = j + 1
+    self.num_decoded += 1
+
+  def _next_block(self):
+    if self.j >= len(self.datas):
+      if self.exhausted:
+        return False
+      self._fetch(self.lasts[-1] if len(self.lasts) > 0 else None)
+      if len(self.datas) == 0:
+        return False
+    self._decode(self.j)
+    return True
+
+  def _check_hi(self, r):
+    if self.hi is not None and r >= self.hi:
+      self.block, self.i = [], 0
+      self.lasts, self.datas, self.j = [], [], 0
+      self.exhausted = True
+      raise StopIteration
+    return r
+
+  def __next__(self):
+    if not self.started and self.lo is not None:
+      return self.seek(self.lo)
+    self.started = True
+    while self.i >= len(self.block):
+      if not self._next_block():
+        raise StopIteration
+    self.i += 1
+    return self._check_hi(self.block[self.i - 1])
+
+  def seek(self, target):
+    self.started = True
+    if self.lo is not None and target < self.lo:
+      target = self.lo
+    if len(self.block) > 0 and self.block[-1] >= target:
+      self.i = gallop(self.block, target, self.i)
+      return next(self)
+    # Skip to the only block that can contain target.
+    j = bisect.bisect_left(self.lasts, target, self.j)
+    if j >= len(self.lasts):
+      if self.exhausted:
+        self.block, self.i, self.j = [], 0, len(self.datas)
+        raise StopIteration
+      self._fetch(target, inclusive=True)
+      if len(self.datas) == 0:
+        self.block, self.i = [], 0
+        raise StopIteration
+      j = 0
+    self._decode(j)
+    self.i = gallop(self.block, target)
+    return next(self)
+
+"""
+Result orderings.  Every posting list in a query is walked in the same
+order, so the merge produces results already sorted and stops as soon as
+it has max_results of them: the first k postings out of the merge are the
+top k, and no posting after them is ever read.
+
+Score order walks "tokens" (or its packed/hot forms); newest and oldest
+first walk "time_tokens" (see sqlindex.build_time_order) backwards and
+forwards.
+"""
+class Ordering:
+  def __init__(self, name, table, key, sign):
+    self.name = name
+    self.table = table
+    self.key = key
+    self.sign = sign
+
+  def comment_id(self, posting):
+    return self.sign * posting[1]
+
+  def cursor(self, sql_cursor, where, params=()):
+    return PostingCursor(sql_cursor, where, params, table=self.table, key=self.key, sign=self.sign)
+
+kByScore = Ordering('score', 'tokens', 'comment_score', 1)
+kNewest = Ordering('new', 'time_tokens', 'created_utc', -1)
+kOldest = Ordering('old', 'time_tokens', 'created_utc', 1)
+kOrderings = {o.name: o for o in [kByScore, kNewest, kOldest]}
+
+kSortRegex = re.compile(r'(?<!\S)sort:(\S*)')
+
+def has_ordering(sql_cursor, ordering):
+  return ordering is kByScore or has_time_order(sql_cursor)
 
-def token_iterator(token, chunksize=kDefaultChunkSize, limit=kDefaultLimit):
+# Hash as stored in the "tokens" table (0 is reserved for the row every
+# comment gets, which score_iterator walks).  Older indexes use an older
+# hash, so the hash function depends on the index.
+def token_hash(sql_cursor, token):
   if token is None:
-    h = 0
-  else:
-    h = hashfn(token) - (1 << 63)
-  r = []
-  i = 0
+    return 0
+  return index_hashfn(sql_cursor)(token)
+
+# The token's memory-mapped posting list if it's one of the index's most
+# frequent tokens (see hotlists.py), otherwise None.
+def hot_postings(sql_cursor, h):
+  hot = index_hot_lists(sql_cursor)
+  return None if hot is None else hot.get(h)
+
+def limited(it, limit):
   num_returned = 0
-  offset = 0
-  while True:
-    if i >= len(r):
-      i -= len(r)
-      offset += len(r)
-      r = c.execute(f"""
-        SELECT comment_score, comment_id
-        FROM tokens
-        WHERE token_hash={h}
-        ORDER BY comment_score, comment_id
-        LIMIT {chunksize}
-        OFFSET {offset}""").fetchall()
-    if i >= len(r):
-      return
-    yield r[i]
+  for r in it:
+    yield r
     num_returned += 1
     if num_returned >= limit:
       yield kMaxVal
       return
-    i += 1
 
-def score_iterator(score, chunksize=kDefaultChunkSize, limit=kDefaultLimit, op='>'):
-  r = []
-  i = 0
-  num_returned = 0
-  offset = 0
-  while True:
-    if i >= len(r):
-      i -= len(r)
-      offset += len(r)
-      r = c.execute(f"""
-        SELECT comment_score, comment_id
-        FROM tokens
-        WHERE comment_score{op}{score}
-        AND token_hash=0
-        ORDER BY comment_score, comment_id
-        LIMIT {chunksize}
-        OFFSET {offset}""").fetchall()
-      print('score', r[:10])
-    if i >= len(r):
-      yield kMaxVal
-      return
-    yield r[i]
-    num_returned += 1
-    if num_returned >= kDefaultLimit:
-      return
-    i += 1
+# Unlimited iterators are returned as bare cursors so the merge operators
+# can seek() them.
+def token_iterator(token, chunksize=kFirstChunkSize, limit=kDefaultLimit, sql_cursor=None, ordering=kByScore):
+  if sql_cursor is None:
+    sql_cursor = c
+  h = token_hash(sql_cursor, token)
+  hot = hot_postings(sql_cursor, h) if ordering is kByScore else None
+  if ordering is not kByScore:
+    cursor = ordering.cursor(sql_cursor, 'token_hash=?', (h,))
+  elif hot is not None:
+    cursor = ListSeeker(hot)
+  elif index_posting_format(sql_cursor) == 'blocks':
+    cursor = BlockCursor(sql_cursor, h)
+  else:
+    cursor = PostingCursor(sql_cursor, 'token_hash=?', (h,), chunksize=chunksize)
+  if limit == float('inf'):
+    return cursor
+  return limited(cursor, limit)
+
+def score_iterator(score, chunksize=kFirstChunkSize, limit=kDefaultLimit, op='>', sql_cursor=None):
+  assert op in ['<', '>', '=']
+  if sql_cursor is None:
+    sql_cursor = c
+  if index_posting_format(sql_cursor) == 'blocks':
+    lo, hi = {
+      '<': (None, (score, float('-inf'))),
+      '>': ((score, float('inf')), None),
+      '=': ((score, float('-inf')), (score, float('inf'))),
+    }[op]
+    cursor = BlockCursor(sql_cursor, 0, lo=lo, hi=hi)
+  else:
+    cursor = PostingCursor(sql_cursor, f'token_hash=0 AND comment_score{op}?', (score,), chunksize=chunksize)
+  if limit == float('inf'):
+    return cursor
+  return limited(cursor, limit)
 
 parser = MyHTMLParser()
 conn = sqlite3.connect('new.db')
@@ -130,53 +350,680 @@ def tree_to_iter(tree, limit=kDefaultLimit):
   return token_iterator(tree.op, limit=limit)
 
 """
+Query planning.
+
+If one (or more) of the query tokens is very common, merging its posting
+list can take a very long time (e.g. 2 seconds!) because an overwhelming
+proportion of the common token's documents do not contain the rare tokens.
+
+Instead we estimate the size of every posting list from the "token_stats"
+table, drive the merge with the rarest lists, and check the common ones
+with random access (one index seek per candidate).
+"""
 
-TODO: if one (or more) of the query tokens is very common it can
-take a very long time (e.g. 2 seconds!) to execute because an
-overwhelming proportion of the common token's documents do not
-contain the rare tokens.
+# A term is probed rather than merged if its posting list is more than this
+# many times longer than the rarest list in its conjunction.
+kProbeRatio = 8
 
-A simple solution is to only use rare tokens for merging and use
-random access to check the common tokens.
+def doc_freq(sql_cursor, token):
+  try:
+    r = sql_cursor.execute("SELECT doc_freq FROM token_stats WHERE token_hash=?", (token_hash(sql_cursor, token),)).fetchone()
+  except sqlite3.OperationalError:
+    # No stats; every term looks the same so the plan degrades to merging
+    # everything, which is what we did before there was a planner.
+    return float('inf')
+  return 0 if r is None else r[0]
+
+def contains(sql_cursor, token, posting, ordering=kByScore):
+  if ordering is not kByScore:
+    r = sql_cursor.execute("""
+      SELECT 1 FROM time_tokens
+      WHERE token_hash=? AND created_utc=? AND comment_id=?""", (token_hash(sql_cursor, token),) + tuple(ordering.sign * x for x in posting)).fetchone()
+    return r is not None
+  hot = hot_postings(sql_cursor, token_hash(sql_cursor, token))
+  if hot is not None:
+    i = bisect.bisect_left(hot, tuple(posting))
+    return i < len(hot) and hot[i] == tuple(posting)
+  if index_posting_format(sql_cursor) == 'blocks':
+    r = sql_cursor.execute("""
+      SELECT data FROM posting_blocks
+      WHERE token_hash=? AND (last_score, last_id) >= (?, ?)
+      ORDER BY last_score, last_id
+      LIMIT 1""", (token_hash(sql_cursor, token),) + tuple(posting)).fetchone()
+    if r is None:
+      return False
+    block = decode_block(r[0])
+    i = bisect.bisect_left(block, tuple(posting))
+    return i < len(block) and block[i] == tuple(posting)
+  r = sql_cursor.execute("""
+    SELECT 1 FROM tokens
+    WHERE token_hash=? AND comment_score=? AND comment_id=?""", (token_hash(sql_cursor, token),) + posting).fetchone()
+  return r is not None
 
+"""
+Numeric range filters: score>50, depth<=2, pscore=10..20, created>2021-03.
 
+A value denotes a half-open interval -- 7 is [7, 8), "2021-03" is March
+2021 (local time, like the year: and month: tokens) -- and the operator
+picks the part of the number line relative to it: ">" is everything after
+the interval, ">=" the interval and everything after it, "=" the interval
+itself, and "=a..b" everything from the start of a to the end of b.
 """
+kRangeFields = {
+  'score': 'score',
+  'pscore': 'pscore',
+  'gscore': 'gscore',
+  'depth': 'depth',
+  'created': 'created_utc',
+}
+kRangeRegex = re.compile(r'^(' + '|'.join(kRangeFields) + r')(>=|<=|>|<|=)(.+)$')
+kDateRegex = re.compile(r'^(\d{4})(?:-(\d{1,2})(?:-(\d{1,2}))?)?$')
+
+# Ranges spanning at most this many distinct values are merged from one
+# posting-ordered index run per value.  Wider ones matching fewer than
+# kRangeSortLimit comments are sorted in memory, and the rest are walked in
+# posting order, skipping the comments outside the range (which, since
+# there are so many inside it, costs few rows per result).
+kMaxRangeRuns = 32
+kRangeSortLimit = 10000
+
+# The planner only needs to know whether a range is small, so estimates
+# stop counting here; a count that reaches it means "at least this many".
+kRangeCountLimit = 100000
+
+def parse_interval(field, text):
+  if field == 'created_utc':
+    m = kDateRegex.match(text)
+    if m is not None:
+      year, month, day = m.groups()
+      start = datetime(int(year), int(month or 1), int(day or 1))
+      if day is not None:
+        end = start + timedelta(days=1)
+      elif month is not None:
+        end = datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+      else:
+        end = datetime(start.year + 1, 1, 1)
+      return int(start.timestamp()), int(end.timestamp())
+  value = int(text)
+  return value, value + 1
+
+# Returns (field, lo, hi) for the values lo <= v < hi a range filter
+# selects, or None if `op` isn't one.
+def parse_range(op):
+  m = kRangeRegex.match(op)
+  if m is None:
+    return None
+  name, cmp, text = m.groups()
+  field = kRangeFields[name]
+  inf = float('inf')
+  try:
+    if cmp == '=' and '..' in text:
+      a, b = text.split('..', 1)
+      return field, parse_interval(field, a)[0], parse_interval(field, b)[1]
+    start, end = parse_interval(field, text)
+  except ValueError:
+    return None
+  lo, hi = {
+    '>': (end, inf),
+    '>=': (start, inf),
+    '<': (-inf, start),
+    '<=': (-inf, end),
+    '=': (start, end),
+  }[cmp]
+  return field, lo, hi
 
-def query(sql_cursor, user_query, max_results=100):
-  tokens = user_query.strip().lower().split(' ')
-  it = atleast(
-    *[token_iterator(t, limit=float('inf')) for t in tokens],
-    k=len(tokens),
-    limit=max_results
-  )
+def range_where(field, lo, hi):
+  clauses, params = [], []
+  if lo != float('-inf'):
+    clauses.append(f'{field}>=?')
+    params.append(lo)
+  if hi != float('inf'):
+    clauses.append(f'{field}<?')
+    params.append(hi)
+  return ' AND '.join(clauses), tuple(params)
 
+def range_count(sql_cursor, field, lo, hi, limit=kRangeCountLimit):
+  where, params = range_where(field, lo, hi)
+  try:
+    return sql_cursor.execute(f"""
+      SELECT COUNT(*) FROM (
+        SELECT 1 FROM comment_attrs WHERE {where} LIMIT ?
+      )""", params + (limit,)).fetchone()[0]
+  except sqlite3.OperationalError:
+    return float('inf')
+
+# The first `limit` distinct values in the range, found with one index
+# seek each.
+def range_values(sql_cursor, field, lo, hi, limit):
+  where, params = range_where(field, lo, hi)
   R = []
+  v = sql_cursor.execute(f"SELECT MIN({field}) FROM comment_attrs WHERE {where}", params).fetchone()[0]
+  while v is not None and len(R) < limit:
+    R.append(v)
+    v = sql_cursor.execute(f"SELECT MIN({field}) FROM comment_attrs WHERE {where} AND {field}>?", params + (v,)).fetchone()[0]
+  return R
+
+def range_iterator(sql_cursor, field, lo, hi, limit=kDefaultLimit, ordering=kByScore):
+  cursor = None
+  if field == 'created_utc' and ordering is not kByScore:
+    # A time range is one contiguous run of the token_hash=0 list.
+    where, params = range_where(field, lo, hi)
+    cursor = ordering.cursor(sql_cursor, f'token_hash=0 AND {where}', params)
+  elif field == 'score' and ordering is kByScore:
+    # Postings are ordered by -score, so a score range is one contiguous
+    # run of the token_hash=0 list: lo <= score < hi is
+    # 1 - hi <= comment_score < 1 - lo.
+    slo, shi = 1 - hi, 1 - lo
+    if index_posting_format(sql_cursor) == 'blocks':
+      cursor = BlockCursor(
+        sql_cursor, 0,
+        lo=None if slo == float('-inf') else (slo, float('-inf')),
+        hi=None if shi == float('inf') else (shi, float('-inf')),
+      )
+    else:
+      where, params = range_where('comment_score', slo, shi)
+      cursor = PostingCursor(sql_cursor, f'token_hash=0 AND {where}', params)
+  elif ordering is kByScore:
+    values = range_values(sql_cursor, field, lo, hi, kMaxRangeRuns + 1)
+    if len(values) <= kMaxRangeRuns:
+      # Each value's run of the (field, comment_score, comment_id) index
+      # is already in posting order.
+      cursor = Union([
+        PostingCursor(sql_cursor, f'{field}=?', (v,), table='comment_attrs')
+        for v in values
+      ])
+  if cursor is None:
+    if range_count(sql_cursor, field, lo, hi, limit=kRangeSortLimit) < kRangeSortLimit:
+      where, params = range_where(field, lo, hi)
+      cursor = ListSeeker(sorted((ordering.sign * k, ordering.sign * i) for k, i in sql_cursor.execute(f"""
+        SELECT {ordering.key}, comment_id
+        FROM comment_attrs
+        WHERE {where}""", params)))
+    else:
+      # The unary + keeps sqlite off the field's own index, so it walks
+      # attrs_posting or attrs_time (see sqlindex.ensure_attributes)
+      # instead of sorting the whole range.
+      where, params = range_where('+' + field, lo, hi)
+      cursor = PostingCursor(sql_cursor, where, params, table='comment_attrs', key=ordering.key, sign=ordering.sign)
+  if limit == float('inf'):
+    return cursor
+  return limited(cursor, limit)
+
+def attribute(sql_cursor, field, comment_id):
+  r = sql_cursor.execute(f"SELECT {field} FROM comment_attrs WHERE comment_id=?", (comment_id,)).fetchone()
+  return None if r is None else r[0]
+
+class Plan:
+  def __init__(self, op, cost, children=(), probes=(), token=None, k=None, bounds=None, ordering=kByScore, capped=False):
+    self.op = op  # 'scan', 'range', 'intersect', 'union' or 'atleast'
+    self.cost = cost  # Estimated number of postings produced...
+    self.capped = capped  # ...or at least that many, if a range count was capped.
+    self.children = list(children)
+    self.probes = list(probes)  # 'scan' or 'range' plans checked per candidate.
+    self.token = token
+    self.k = k
+    self.bounds = bounds  # (field, lo, hi) for 'range' plans.
+    self.ordering = ordering
+    self.key = None  # The root's result_cache key (see parse_query).
+
+  def probeable(self):
+    return self.op in ['scan', 'range']
+
+  # Returns whether a posting satisfies this plan by random access.
+  def check(self, sql_cursor, posting):
+    if self.op == 'scan':
+      return contains(sql_cursor, self.token, posting, self.ordering)
+    field, lo, hi = self.bounds
+    if field == 'score' and self.ordering is kByScore:
+      value = -posting[0]
+    elif field == 'created_utc' and self.ordering is not kByScore:
+      value = self.ordering.sign * posting[0]
+    else:
+      value = attribute(sql_cursor, field, self.ordering.comment_id(posting))
+    return value is not None and lo <= value < hi
+
+  def explain(self):
+    lines = self._explain_lines(0)
+    if self.ordering is not kByScore:
+      lines.insert(0, f'sort:{self.ordering.name}')
+    return '\n'.join(lines)
+
+  def rows(self):
+    return f'{">=" if self.capped else "~"}{self.cost} rows'
+
+  def _explain_lines(self, depth):
+    indent = '  ' * depth
+    if self.probeable():
+      lines = [f'{indent}{self.op} {self.token} ({self.rows()})']
+    else:
+      k = f' k={self.k}' if self.op == 'atleast' else ''
+      lines = [f'{indent}{self.op}{k} ({self.rows()})']
+    for child in self.children:
+      lines += child._explain_lines(depth + 1)
+    for probe in self.probes:
+      lines.append(f'{indent}  probe {probe.token} ({probe.rows()})')
+    return lines
+
+def plan_tree(sql_cursor, tree, ordering=kByScore):
+  if tree.op in ['*', '+', '>']:
+    if tree.op == '>':
+      assert tree.children[0].op == '+'
+      children = [plan_tree(sql_cursor, c, ordering) for c in tree.children[0].children]
+      capped = any(p.capped for p in children)
+      return Plan('atleast', sum(p.cost for p in children), children, k=int(tree.children[1].op) + 1, ordering=ordering, capped=capped)
+    children = [plan_tree(sql_cursor, c, ordering) for c in tree.children]
+    if tree.op == '+':
+      return Plan('union', sum(p.cost for p in children), children, ordering=ordering, capped=any(p.capped for p in children))
+
+    # Conjunction: merge on the rarest list (and anything we can't probe),
+    # probe everything that is much more common.  A capped range may be
+    # far bigger than its count, so it only drives if nothing else can.
+    children.sort(key=lambda p: (p.capped, p.cost))
+    rarest = children[0].cost
+    drivers, probes = [], []
+    for p in children:
+      if p is children[0] or not p.probeable() or (not p.capped and p.cost <= rarest * kProbeRatio):
+        drivers.append(p)
+      else:
+        probes.append(p)
+    return Plan('intersect', rarest, drivers, probes, ordering=ordering, capped=children[0].capped)
+
+  r = parse_range(tree.op)
+  if r is not None:
+    count = range_count(sql_cursor, *r)
+    return Plan('range', count, token=tree.op, bounds=r, ordering=ordering, capped=count >= kRangeCountLimit)
+  return Plan('scan', doc_freq(sql_cursor, tree.op), token=tree.op, ordering=ordering)
+
+class ProbeFilter(Seekable):
+  def __init__(self, sql_cursor, it, probes, limit=kDefaultLimit):
+    self.sql_cursor = sql_cursor
+    self.it = it
+    self.probes = probes
+    self.limit = limit
+    self.num_returned = 0
+
+  def _check(self, r):
+    while not all(p.check(self.sql_cursor, r) for p in self.probes):
+      r = next(self.it)
+    self.num_returned += 1
+    return r
+
+  def __next__(self):
+    if self.num_returned >= self.limit:
+      raise StopIteration
+    return self._check(next(self.it))
+
+  def seek(self, target):
+    if self.num_returned >= self.limit:
+      raise StopIteration
+    return self._check(self.it.seek(target))
+
+def plan_to_iter(sql_cursor, plan, limit=kDefaultLimit):
+  if plan.op == 'scan':
+    return token_iterator(plan.token, limit=limit, sql_cursor=sql_cursor, ordering=plan.ordering)
+  if plan.op == 'range':
+    return range_iterator(sql_cursor, *plan.bounds, limit=limit, ordering=plan.ordering)
+
+  inner_limit = limit if len(plan.probes) == 0 else float('inf')
+  if len(plan.children) == 1 and plan.op == 'intersect':
+    it = plan_to_iter(sql_cursor, plan.children[0], limit=inner_limit)
+  else:
+    iters = [plan_to_iter(sql_cursor, p, limit=float('inf')) for p in plan.children]
+    if plan.op == 'intersect':
+      it = intersect(*iters, limit=inner_limit)
+    elif plan.op == 'union':
+      it = union(*iters, limit=inner_limit)
+    else:
+      it = atleast(*iters, k=plan.k, limit=inner_limit)
+  if len(plan.probes) > 0:
+    it = ProbeFilter(sql_cursor, seekable(it), plan.probes, limit=limit)
+  return it
+
+"""
+Bounded LRU cache of decoded comments, keyed by comment_id.  Comments are
+stored with their "tokens" string already sorted, and misses are fetched
+from sqlite in batches.
+"""
+class CommentCache:
+  def __init__(self, maxsize=kCommentCacheSize):
+    self.maxsize = maxsize
+    self.comments = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.version = None
+
+  # Drops everything if the index has changed since the comments were read.
+  def check_version(self, version):
+    with self.lock:
+      if version != self.version:
+        self.comments.clear()
+        self.version = version
+
+  def _fetch(self, sql_cursor, ids):
+    R = {}
+    for i in range(0, len(ids), kMaxSqlParams):
+      batch = ids[i:i + kMaxSqlParams]
+      rows = sql_cursor.execute(f"""
+        SELECT comment_id, json
+        FROM comments
+        WHERE comment_id IN ({','.join('?' * len(batch))})""", batch).fetchall()
+      for comment_id, text in rows:
+        comment = json.loads(text)
+        comment["tokens"] = ' '.join(sorted(comment["tokens"].split(' ')))
+        R[comment_id] = comment
+    return R
+
+  # Returns {comment_id: comment} for the ids that have a comment.  Ids
+  # without one (deleted since their postings were read, e.g. by an
+  # incremental update) are left out.  The comments are shared with the
+  # cache, so don't modify them.
+  def lookup(self, sql_cursor, ids):
+    found = {}
+    missing = []
+    with self.lock:
+      for i in ids:
+        if i in self.comments:
+          found[i] = self.comments[i]
+          self.comments.move_to_end(i)
+        else:
+          missing.append(i)
+      self.hits += len(ids) - len(missing)
+      self.misses += len(missing)
+
+    if len(missing) > 0:
+      fetched = self._fetch(sql_cursor, missing)
+      found.update(fetched)
+      with self.lock:
+        self.comments.update(fetched)
+        while len(self.comments) > self.maxsize:
+          self.comments.popitem(last=False)
+
+    return found
+
+  # Returns the comments in the order of `ids`, skipping missing ones.
+  # Callers get shallow copies so they are free to decorate them (e.g. with
+  # highlighted html).
+  def get_many(self, sql_cursor, ids):
+    found = self.lookup(sql_cursor, ids)
+    return [dict(found[i]) for i in ids if i in found]
+
+  def stats(self):
+    total = self.hits + self.misses
+    return {
+      "hits": self.hits,
+      "misses": self.misses,
+      "size": len(self.comments),
+      "hit_ratio": self.hits / total if total > 0 else 0.0,
+    }
+
+comment_cache = CommentCache()
+
+# Yields the first `limit` postings of the plan's results, or the first
+# `limit` after the posting `after` -- which costs a seek, not a rescan.
+def iter_postings(sql_cursor, plan, limit, after=None):
+  if limit <= 0:
+    return
+  if after is None:
+    for r in plan_to_iter(sql_cursor, plan, limit=limit):
+      if r == kMaxVal:
+        return
+      yield r
+    return
+  it = seekable(plan_to_iter(sql_cursor, plan, limit=float('inf')))
   try:
-    for i in range(max_results):
-      R.append(next(it))
+    # Postings are pairs of ints, so this is the smallest one after `after`.
+    r = it.seek((after[0], after[1] + 1))
+    for _ in range(limit):
+      yield r
+      r = next(it)
   except StopIteration:
-    pass
-  if len(R) > 0 and R[-1] == kMaxVal:
-    R.pop()
-
-  R = [
-    json.loads(c.execute(f"SELECT json FROM comments WHERE comment_id={r[1]}").fetchone()[0]) for r in R
-  ]
-  for i in range(len(R)):
-    T = R[i]["tokens"].split(' ')
-    T.sort()
-    R[i]["tokens"] = ' '.join(T)
+    return
+
+class ResultEntry:
+  def __init__(self, version, postings, exhausted):
+    self.version = version
+    self.time = time.time()
+    self.postings = postings
+    self.exhausted = exhausted  # Whether these are all the results.
+
+"""
+Bounded LRU cache of the postings queries produced, keyed by the index,
+the ordering and the normalized query tree (see tree_key).
+
+Entries remember the index version they were computed at and are dropped
+once it changes, or after `ttl` seconds.  A query for more results than an
+entry holds reuses it as a prefix and resumes the merge after its last
+posting.
+"""
+class ResultCache:
+  def __init__(self, maxsize=kResultCacheSize, max_postings=kResultCacheMaxPostings, ttl=kResultCacheTTL):
+    self.maxsize = maxsize
+    self.max_postings = max_postings
+    self.ttl = ttl
+    self.entries = OrderedDict()
+    self.num_postings = 0
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.partial_hits = 0
+    self.misses = 0
+    self.invalidations = 0
+
+  def _remove(self, key):
+    self.num_postings -= len(self.entries.pop(key).postings)
+
+  # Returns the entry for `key` (or None), counting it as a hit if it
+  # covers the first `n` results.
+  def get(self, key, version, n):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None and (entry.version != version or time.time() - entry.time > self.ttl):
+        self._remove(key)
+        self.invalidations += 1
+        entry = None
+      if entry is None:
+        self.misses += 1
+      elif entry.exhausted or len(entry.postings) >= n:
+        self.hits += 1
+      else:
+        self.partial_hits += 1
+      if entry is not None:
+        self.entries.move_to_end(key)
+      return entry
+
+  def put(self, key, version, postings, exhausted):
+    with self.lock:
+      if key in self.entries:
+        self._remove(key)
+      self.entries[key] = ResultEntry(version, postings, exhausted)
+      self.num_postings += len(postings)
+      while len(self.entries) > self.maxsize or self.num_postings > self.max_postings:
+        self._remove(next(iter(self.entries)))
+
+  def stats(self):
+    total = self.hits + self.partial_hits + self.misses
+    return {
+      "hits": self.hits,
+      "partial_hits": self.partial_hits,
+      "misses": self.misses,
+      "invalidations": self.invalidations,
+      "size": len(self.entries),
+      "postings": self.num_postings,
+      "hit_ratio": self.hits / total if total > 0 else 0.0,
+      "reuse_ratio": (self.hits + self.partial_hits) / total if total > 0 else 0.0,
+    }
+
+result_cache = ResultCache()
+
+# A canonical string for a query tree: the operands of "*" and "+" are
+# sorted, so "a b" and "b a" share a cache entry.
+def tree_key(tree):
+  if len(tree.children) == 0:
+    return tree.op
+  children = [tree_key(child) for child in tree.children]
+  if tree.op in ['*', '+']:
+    children.sort()
+  return f'({tree.op} {" ".join(children)})'
+
+# Yields the plan's first max_results postings, through result_cache.
+def cached_postings(sql_cursor, plan, max_results):
+  if plan.key is None:
+    yield from iter_postings(sql_cursor, plan, max_results)
+    return
+  version = index_version(sql_cursor)
+  entry = result_cache.get(plan.key, version, max_results)
+  if entry is not None and (entry.exhausted or len(entry.postings) >= max_results):
+    yield from entry.postings[:max_results]
+    return
+
+  R = [] if entry is None else list(entry.postings)
+  yield from R
+  after = R[-1] if len(R) > 0 else None
+  for r in iter_postings(sql_cursor, plan, max_results - len(R), after):
+    R.append(r)
+    yield r
+  result_cache.put(plan.key, version, R, exhausted=len(R) < max_results)
+
+# `order` names the ordering (see kOrderings); a sort:new, sort:old or
+# sort:score term in the query overrides it.
+def parse_query(sql_cursor, user_query, order='score'):
+  # Picks up a rehashed or (un)packed index (see sqlindex.cached_per_version).
+  index_version(sql_cursor)
+  user_query = user_query.strip().lower()
+  for name in kSortRegex.findall(user_query):
+    order = name
+  if order not in kOrderings:
+    raise ValueError(f'unknown ordering "{order}" (expected one of {", ".join(kOrderings)})')
+  ordering = kOrderings[order]
+  if not has_ordering(sql_cursor, ordering):
+    raise ValueError(f'this index can\'t sort by "{order}" (see sqlindex.py --time-order)')
+  user_query = kSortRegex.sub('', user_query).strip()
+  tokens = user_query.split(' ')
+  tree = query_to_tree(user_query)
+  plan = plan_tree(sql_cursor, tree, ordering)
+  plan.key = (index_path(sql_cursor), ordering.name, tree_key(tree))
+  return tokens, plan
+
+"""
+Continuation tokens.  Results come out of the merge in posting order, so
+"the results after this one" only needs the last posting: every operator
+below the root can seek straight to it (see iter_postings).  A token holds
+the ordering, that posting and the number of results before it.
+"""
+def continuation_token(ordering, posting, n):
+  data = json.dumps([ordering.name, posting[0], posting[1], n], separators=(',', ':'))
+  return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+# Returns (ordering name, posting, n) for a token.
+def parse_continuation(token):
+  try:
+    name, a, b, n = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    assert name in kOrderings and all(type(x) is int for x in [a, b, n])
+  except Exception:
+    raise ValueError('invalid continuation token')
+  return name, (a, b), n
+
+# Returns (posting, n) to resume `plan` after.
+def resume_point(plan, after):
+  name, posting, n = parse_continuation(after)
+  if name != plan.ordering.name:
+    raise ValueError(f'continuation token is for sort:{name}, not sort:{plan.ordering.name}')
+  return posting, n
+
+"""
+One page of a query's results as hydrated comments, in batches as the
+merge produces them, so callers can start rendering before the query
+finishes.  The first batch is small to get the first results out quickly.
+
+Each comment's "after" is the continuation token for the results after
+it.  Once the batches are exhausted, `more` says whether there are results
+past this page and `next` is the token for the following page (or None).
+Both go by postings, not comments: a posting whose comment has gone (see
+CommentCache.lookup) is skipped but still counts, so the next page starts
+after the page's last posting whether or not it was shown.
+"""
+class CommentPage:
+  def __init__(self, sql_cursor, plan, page_size=100, batch_sizes=kBatchSizes, after=None):
+    self.sql_cursor = sql_cursor
+    self.plan = plan
+    self.page_size = page_size
+    self.batch_sizes = list(batch_sizes)
+    self.after = after
+    self.more = False
+    self.next = None
+
+  # `n` is the number of results before `batch`.
+  def _hydrate(self, batch, n):
+    ids = [self.plan.ordering.comment_id(r) for r in batch]
+    found = comment_cache.lookup(self.sql_cursor, ids)
+    comments = []
+    for id_, r in zip(ids, batch):
+      n += 1
+      if id_ not in found:
+        continue
+      comment = dict(found[id_])
+      comment['after'] = continuation_token(self.plan.ordering, r, n)
+      comments.append(comment)
+    return comments
+
+  def __iter__(self):
+    comment_cache.check_version(index_version(self.sql_cursor))
+    # One posting more than the page, to learn whether there's another.
+    if self.after is None:
+      postings = cached_postings(self.sql_cursor, self.plan, self.page_size + 1)
+      n = 0
+    else:
+      posting, n = resume_point(self.plan, self.after)
+      postings = iter_postings(self.sql_cursor, self.plan, self.page_size + 1, posting)
+    end = n + self.page_size
+
+    batch_sizes = list(self.batch_sizes)
+    batch = []
+    last = None
+    for r in postings:
+      if n + len(batch) >= end:
+        # Read to the end anyway, so cached_postings can cache the page.
+        self.more = True
+        continue
+      batch.append(r)
+      last = r
+      if len(batch) >= batch_sizes[0]:
+        yield self._hydrate(batch, n)
+        n += len(batch)
+        batch = []
+        if len(batch_sizes) > 1:
+          batch_sizes.pop(0)
+    if len(batch) > 0:
+      yield self._hydrate(batch, n)
+    if self.more and last is not None:
+      self.next = continuation_token(self.plan.ordering, last, end)
+
+# "next" is the continuation token for the following page, or None if
+# there are no more results.
+def query(sql_cursor, user_query, max_results=100, order='score', after=None):
+  tokens, plan = parse_query(sql_cursor, user_query, order)
+  page = CommentPage(sql_cursor, plan, page_size=max_results, batch_sizes=[max_results], after=after)
+  R = []
+  for batch in page:
+    R += batch
   return {
     "comments": R,
     "tokens": tokens,
-    "num_excluded": 0
+    "num_excluded": 0,
+    "plan": plan.explain(),
+    "next": page.next,
   }
 
 
 if __name__ == '__main__':
   conn = sqlite3.connect('new.db')
   c = conn.cursor()
+  ensure_indices(c)
+  ensure_token_stats(c)
+  ensure_attributes(c)
+  conn.commit()
   R = query(c, 'year:2020 author:you-get-an-upvote many')
+  print(R['plan'])
 
 # graces point year:2020 author:HlynkaCG
 
@@ -0,0 +1,155 @@
+"""
+Client-side rate limiting for the reddit API.
+
+Reddit allows each OAuth client a fixed number of requests per window (600
+per 10 minutes at the time of writing) and reports where we stand in every
+response:
+
+  X-Ratelimit-Remaining: requests left in the current window
+  X-Ratelimit-Reset:     seconds until the window resets
+
+A fixed delay between requests has to be tuned for the worst case and
+wastes most of the quota.  Instead, requests draw from a token bucket whose
+refill rate is recomputed from those headers after every response: the
+remaining requests are spread evenly over the rest of the window, so we go
+as fast as the quota allows and never faster.  The bucket's capacity allows
+short bursts (e.g. a batch of morechildren requests) without waiting.
+
+Failures (429s, 5xxs, dropped connections) back off exponentially with full
+jitter.  A backoff pauses the whole bucket rather than just the request that
+failed, since every thread is spending the same quota.
+"""
+
+import random, threading, time
+
+kDefaultRate = 1.0       # Requests/sec until we've seen any headers.
+kDefaultCapacity = 10    # Largest burst.
+kMaxRate = 10.0          # Never faster than this, whatever the quota says.
+kSafetyMargin = 5        # Requests of the window's quota we leave unused.
+kBackoffBase = 2.0       # Seconds; doubled on every consecutive failure...
+kBackoffCap = 120.0      # ...up to this.
+
+def _header_float(headers, name):
+  try:
+    return float(headers[name])
+  except (KeyError, TypeError, ValueError):
+    return None
+
+"""
+A thread-safe token bucket.  acquire() takes one token, sleeping until it
+is available; callers reserve tokens in the order they arrive, so the bucket
+can go negative and later callers queue behind earlier ones.
+"""
+class TokenBucket:
+  def __init__(self, rate, capacity):
+    self.rate = rate
+    self.capacity = capacity
+    self.tokens = capacity
+    self.last = time.monotonic()
+    self.resume_at = 0  # Nothing may be acquired before this (monotonic) time.
+    self.lock = threading.Lock()
+
+  def _refill(self, now):
+    self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+    self.last = now
+
+  # Returns how long the caller must wait for its token.
+  def reserve(self):
+    with self.lock:
+      now = time.monotonic()
+      self._refill(now)
+      self.tokens -= 1
+      wait = 0 if self.tokens >= 0 else -self.tokens / self.rate
+      return max(wait, self.resume_at - now)
+
+  def acquire(self):
+    wait = self.reserve()
+    if wait > 0:
+      time.sleep(wait)
+    return wait
+
+  def set_rate(self, rate, capacity=None):
+    with self.lock:
+      self._refill(time.monotonic())
+      self.rate = rate
+      if capacity is not None:
+        self.capacity = capacity
+        self.tokens = min(self.tokens, capacity)
+
+  # Blocks every acquire() for the next `secs` seconds.
+  def pause(self, secs):
+    with self.lock:
+      self.resume_at = max(self.resume_at, time.monotonic() + secs)
+
+"""
+A TokenBucket driven by reddit's rate-limit headers, plus jittered backoff
+and counters for how the time went.  wait_secs is summed over all threads,
+and includes time spent paused by backoffs.
+"""
+class RateLimiter:
+  def __init__(self, rate=kDefaultRate, capacity=kDefaultCapacity, max_rate=kMaxRate, safety_margin=kSafetyMargin):
+    self.bucket = TokenBucket(rate, capacity)
+    self.max_capacity = capacity
+    self.max_rate = max_rate
+    self.safety_margin = safety_margin
+    self.lock = threading.Lock()
+    self.start = time.time()
+    self.requests = 0
+    self.wait_secs = 0.
+    self.backoffs = 0
+    self.backoff_secs = 0.
+    self.errors = {}  # status code (or exception name) -> count
+    self.remaining = None
+    self.reset = None
+
+  # Call before every request.
+  def acquire(self):
+    wait = self.bucket.acquire()
+    with self.lock:
+      self.requests += 1
+      self.wait_secs += wait
+
+  # Call with every response's headers.
+  def update(self, headers):
+    remaining = _header_float(headers, 'X-Ratelimit-Remaining')
+    reset = _header_float(headers, 'X-Ratelimit-Reset')
+    if remaining is None or reset is None:
+      return
+    with self.lock:
+      self.remaining, self.reset = remaining, reset
+    usable = remaining - self.safety_margin
+    if usable < 1:
+      # Out of quota: wait for the window to reset.
+      self.bucket.pause(reset + 1)
+      return
+    rate = min(self.max_rate, usable / max(reset, 1))
+    self.bucket.set_rate(rate, max(1, min(self.max_capacity, usable)))
+
+  # Call after a failed attempt (the attempt-th consecutive one, from 0).
+  # Pauses the bucket for a jittered exponential delay, or for `delay` if
+  # the server said how long to wait.  Returns the pause.
+  def backoff(self, attempt, error, delay=None):
+    if delay is None:
+      delay = random.uniform(0, min(kBackoffCap, kBackoffBase * 2 ** attempt))
+    self.bucket.pause(delay)
+    with self.lock:
+      self.backoffs += 1
+      self.backoff_secs += delay
+      self.errors[error] = self.errors.get(error, 0) + 1
+    return delay
+
+  def stats(self):
+    with self.lock:
+      elapsed = time.time() - self.start
+      return {
+        'requests': self.requests,
+        'elapsed_secs': elapsed,
+        'requests_per_sec': self.requests / max(elapsed, 1e-9),
+        'rate': self.bucket.rate,
+        'wait_secs': self.wait_secs,
+        'backoffs': self.backoffs,
+        'backoff_secs': self.backoff_secs,
+        'errors': dict(self.errors),
+        'remaining': self.remaining,
+        'reset': self.reset,
+      }
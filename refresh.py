@@ -15,11 +15,30 @@ https://alpscode.com/blog/how-to-use-reddit-api/
 
 """
 
-import code, json, math, os, time
+import argparse, code, concurrent.futures, json, math, os, threading, time
 from datetime import datetime
 import requests
+from crawlstate import CrawlState, kFull, kShallow, kSkip
+from ratelimit import RateLimiter
 pjoin = os.path.join
 
+kApiBase = 'https://api.reddit.com'
+kAuthUrl = 'https://www.reddit.com/api/v1/access_token'
+
+# Reddit's limit on the number of ids in one morechildren request.
+kMaxMoreChildren = 100
+# Reddit allows one morechildren request in flight per client; Reddit
+# enforces this across every Submission (see Reddit.morechildren_slots).
+kMaxMoreChildrenInFlight = 1
+# Morechildren requests a Submission keeps in flight at once.  More than
+# kMaxMoreChildrenInFlight just queue.
+kMoreChildrenWorkers = 1
+# Attempts per request, and the timeout (in seconds) of each.
+kMaxTries = 5
+kRequestTimeout = 30
+# Orders Submission.complete tries after the first crawl.
+kExtraOrders = ['old', 'top', 'controversial', 'random']
+
 """
 0: no printing
 1: errors
@@ -27,14 +46,6 @@ pjoin = os.path.join
 """
 VERBOSITY = 2
 
-class Throttler:
-  def __init__(self, qps):
-    self.waitTime = 1. / qps
-    self.lastTime = 0
-  def throttle(self):
-    time.sleep(max(0, self.waitTime - (time.time() - self.lastTime)))
-    self.lastTime = time.time()
-
 class MoreComments:
   def __init__(self, reddit, json, submission):
     assert json['kind'] == 'more'
@@ -46,26 +57,84 @@ class MoreComments:
   def parent_id(self):
     return self.json['parent_id'][3:]
 
-  def fetch(self):
-    if len(self.json["children"]) == 0:
-      return [], []
+class Comment:
+  def __init__(self, json):
+    assert json['kind'] == 't1', json['kind']
+    self.json = json['data']
+    self.id = self.json['id']
 
-    pid = self.parent_id()
-    if pid == self.submission.json['id']:
-      link_id = 't3_' + pid
-    elif pid in self.submission.comments:
-      link_id = self.submission.comments[pid].json['link_id']
+"""
+Expands a submission's "more" stubs.  The morechildren endpoint accepts up
+to kMaxMoreChildren ids from anywhere in the thread, so instead of fetching
+stubs one at a time we pool their children and request them in full
+batches, keeping up to `workers` requests in flight.  Every request goes
+through Reddit.request, so they all draw on the one rate limiter, and holds
+one of the Reddit's morechildren slots, since reddit documents the endpoint
+as one request at a time per client.
+
+A partial batch is only sent when nothing else is in flight; otherwise the
+in-flight responses will probably bring more stubs to fill it.
+
+Errors reddit reports in the response body (e.g. for too many requests)
+are retried after a backoff.  Batches that still fail are left unresolved
+for Submission.complete to retry in another order.
+"""
+class MoreChildrenScheduler:
+  def __init__(self, reddit, submission, workers=kMoreChildrenWorkers):
+    self.reddit = reddit
+    self.submission = submission
+    self.workers = workers
+    self.pending = []  # Child ids waiting to be requested.
+    self.requested = set()
+    self.num_requests = 0
+
+  def add(self, more):
+    for id_ in more.json['children']:
+      if id_ not in self.requested and not self.submission.knows(id_):
+        self.requested.add(id_)
+        self.pending.append(id_)
+
+  def _next_batch(self):
+    batch = self.pending[:kMaxMoreChildren]
+    del self.pending[:kMaxMoreChildren]
+    self.num_requests += 1
+    return batch
+
+  # Fetches until no stubs are left.  Responses are handled on this thread,
+  # so the submission's state is never touched concurrently.
+  def run(self):
+    if len(self.pending) == 0:
+      return
+    with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+      inflight = set()
+      while len(self.pending) or len(inflight):
+        while len(self.pending) and len(inflight) < self.workers:
+          if len(self.pending) < kMaxMoreChildren and len(inflight):
+            break
+          inflight.add(executor.submit(self.fetch, self._next_batch()))
+        done, inflight = concurrent.futures.wait(inflight, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+          self.submission._add(*future.result())
+
+  def fetch(self, children):
+    link_id = 't3_' + self.submission.id
+    url = f'{self.reddit.api_base}/api/morechildren?api_type=json&link_id={link_id}&children={",".join(children)}&order={self.submission.order}'
+    for attempt in range(kMaxTries):
+      with self.reddit.morechildren_slots:
+        result = self.reddit.request(url)
+      if result is None:
+        return [], []
+      errors = result['json']['errors']
+      if len(errors) == 0:
+        break
+      if VERBOSITY > 0:
+        print('morechildren errors:', errors)
+      self.reddit.limiter.backoff(attempt, 'morechildren')
     else:
-      raise Exception('A "MoreComment" should always have an existing parent')
-
-    url = f'https://api.reddit.com/api/morechildren?api_type=json&link_id={link_id}&children={",".join(self.json["children"])}&order={self.submission.order}'
-    result = self.reddit.request(url)
-    if result is None:
       return [], []
-    assert len(result['json']['errors']) == 0
 
     children = result['json']['data']['things']
-    
+
     comments, mores = [], []
     for child in children:
       assert child['kind'] in ['t1', 'more'], child['kind']
@@ -76,23 +145,47 @@ class MoreComments:
 
     return comments, mores
 
-class Comment:
-  def __init__(self, json):
-    assert json['kind'] == 't1', json['kind']
-    self.json = json['data']
-    self.id = self.json['id']
-
+"""
+A submission and its comments.  The constructor crawls the comment tree in
+one order; complete() can then crawl it in further orders to find comments
+reddit didn't return the first time.  With expand=False only the initial
+listing is fetched (its "more" stubs are left unexpanded).
+
+Ids in `known` (plus every comment already fetched) are never requested
+again, so each extra order costs one listing request plus morechildren
+requests for just the stubs that are still unresolved.  `fetched` counts
+comments received and `duplicates` those we already knew.
+"""
 class Submission:
-  def __init__(self, reddit, submission_id, order):
+  def __init__(self, reddit, submission_id, order, workers=kMoreChildrenWorkers, expand=True):
+    self.reddit = reddit
+    self.id = submission_id
+    self.workers = workers
+    self.json = None
+    self.comments = {}
+    self.known = set()
+    self.fetched = 0
+    self.duplicates = 0
+    self.num_requests = 0
+    self.crawl(order, expand)
+
+  def knows(self, id_):
+    return id_ in self.comments or id_ in self.known
+
+  # Fetches the comment listing in `order` and (if `expand`) its stubs.
+  # Returns the number of comments that were new, or None if the listing
+  # failed.
+  def crawl(self, order, expand=True):
     assert order in ['confidence', 'top', 'new', 'controversial', 'old', 'random', 'qa', 'live']
     self.order = order
 
     # url = f'https://api.reddit.com/comments/{submission_id}/api/comments&api_type=json&limit=100&sort={order}'
-    url = f'https://api.reddit.com/comments/{submission_id}.json?limit=500&sort={order}'
-    result = reddit.request(url)
+    url = f'{self.reddit.api_base}/comments/{self.id}.json?limit=500&sort={order}'
+    result = self.reddit.request(url)
+    self.num_requests += 1
     if result is None:
       if VERBOSITY > 0:
-        print(f'Error fetching submission {submission_id}')
+        print(f'Error fetching submission {self.id}')
       return None
 
     submission, children = result
@@ -108,24 +201,36 @@ class Submission:
     children = children['data']['children']
 
     # Fetch all comments.
-    self.comments = {}
-    self.seenit = set()
-    self.mores = []
+    n = len(self.comments)
+    self.scheduler = MoreChildrenScheduler(self.reddit, self, self.workers)
     self._process_list(children)
-    while len(self.mores):
-      newMores = []
-      for more in self.mores:
-        newMores += self._more(more)
-      self.mores = newMores
+    if expand:
+      self.scheduler.run()
+    self.num_requests += self.scheduler.num_requests
+    return len(self.comments) - n
+
+  # Crawls in each of `orders` in turn until one adds nothing new or every
+  # comment is known.  `known` are ids we have from elsewhere (e.g. a
+  # previous run) and needn't fetch.
+  def complete(self, orders, known=()):
+    self.known.update(known)
+    for order in orders:
+      if len(self.known | self.comments.keys()) >= self.json['num_comments']:
+        break
+      if not self.crawl(order):
+        break
+
+  def _add_comment(self, c):
+    self.fetched += 1
+    if self.knows(c.id):
+      self.duplicates += 1
+    self.comments[c.id] = c
 
   def _process_list(self, listing):
     for c in listing:
       assert c['kind'] in ['t1', 'more']
       if c['kind'] == 'more':
-        m = MoreComments(reddit, c, self)
-        if m.id not in self.seenit:
-          self.seenit.add(m.id)
-          self.mores.append(m)
+        self.scheduler.add(MoreComments(self.reddit, c, self))
         assert 'replies' not in c['data']
       else:
         if 'replies' in c['data']:
@@ -133,54 +238,63 @@ class Submission:
           del c['data']['replies']
         else:
           r = None
-        c = Comment(c)
-        self.comments[c.id] = c
+        self._add_comment(Comment(c))
         if r:
           assert r['kind'] == 'Listing'
           self._process_list(r['data']['children'])
 
-  def _more(self, more):
-    newMores = []
-    comments, mores = more.fetch()
+  # Adds the results of one morechildren request.
+  def _add(self, comments, mores):
     for c in comments:
-      assert c.id not in self.comments
       assert type(c) is Comment
-      self.comments[c.id] = c
+      self._add_comment(c)
     for m in mores:
-      if m.id not in self.seenit:
-        newMores.append(m)
-        self.seenit.add(m.id)
+      self.scheduler.add(m)
     if VERBOSITY > 1:
       print(len(self.comments), 'comments')
-    return newMores
 
 
 """
-Maintains reddit authentication, responsible for throttling, and
+Maintains reddit authentication, responsible for rate limiting, and
 fulfills api requests (trying multiple times if necessary).
+
+Requests go through one requests.Session, so connections are kept alive
+between them, and may be made from several threads at once.  `api_base` and
+`auth_url` can point at a local server that replays canned responses (see
+stub_reddit.py).
 """
 class Reddit:
-  def __init__(self):
-    with open('secret.json', 'r') as f:
+  def __init__(self, secret_path='secret.json', api_base=kApiBase, auth_url=kAuthUrl, max_morechildren=kMaxMoreChildrenInFlight):
+    with open(secret_path, 'r') as f:
       self.secret = json.load(f)
     self.appid = self.secret['appid']
     self.appsecret = self.secret['appsecret']
     self.useragent = self.secret['useragent']
-    self.throttler = Throttler(0.4)
-
+    self.api_base = api_base
+    self.auth_url = auth_url
+    self.limiter = RateLimiter()
+    self.session = requests.Session()
+    # Held for every morechildren request, by every thread.
+    self.morechildren_slots = threading.BoundedSemaphore(max_morechildren)
+
+    self.auth_lock = threading.Lock()
     self.expiresAt = 0
     self.authenticate()
 
   # Refreshes self.auth if necessary.
   def authenticate(self):
+    with self.auth_lock:
+      self._authenticate()
+
+  def _authenticate(self):
     # We add a 1 minute buffer just to be safe.
     if time.time() + 60 < self.expiresAt:
       return
     if VERBOSITY > 0:
       print('authenticating')
-    self.throttler.throttle()
-    r = requests.post(
-      'https://www.reddit.com/api/v1/access_token',
+    self.limiter.acquire()
+    r = self.session.post(
+      self.auth_url,
       data = {
         'grant_type': 'password',
         'username': self.secret['username'],
@@ -207,12 +321,14 @@ class Reddit:
 
     R = []
     kMaxPageSize = 100
-    kBaseUrl = f'https://api.reddit.com/r/{subreddit}/new?limit={kMaxPageSize}'
+    kBaseUrl = f'{self.api_base}/r/{subreddit}/new?limit={kMaxPageSize}'
 
     seenit = set()
 
     # Initial request for last 100 posts.
     response = self.request(kBaseUrl)
+    if response is None:
+      return R
     assert response['kind'] == 'Listing'
     submissions = response['data']['children']
     for i, submission in enumerate(submissions):
@@ -224,6 +340,8 @@ class Reddit:
     # Follow up requests for additional of posts.
     while (len(R) < limit) and (time.time() - R[-1]['created_utc'] < max_age):
       response = self.request(kBaseUrl + f'&after=t3_{R[-1]["id"]}')
+      if response is None:
+        break
       assert response['kind'] == 'Listing'
       submissions = response['data']['children']
       if len(submissions) == 0:
@@ -240,117 +358,221 @@ class Reddit:
     R = [r for r in R if time.time() - r['created_utc'] < max_age]
     return R
   
-  # Makes a request to a reddit API url.
-  def request(self, url, max_tries=3, headers=None):
+  # Makes a request to a reddit API url, returning the decoded JSON, or None
+  # if it failed.  Rate limiting (429), server errors and dropped
+  # connections are retried after a backoff.
+  def request(self, url, max_tries=kMaxTries, headers=None):
     assert max_tries > 0
 
-    # Refresh authentication if necessary.
-    self.authenticate()
+    for attempt in range(max_tries):
+      # Refresh authentication if necessary.
+      self.authenticate()
+
+      # Create headers.
+      h = {} if headers is None else dict(headers)
+      if 'Authorization' not in h:
+        h['Authorization'] = self.auth['access_token']
+      if 'User-Agent' not in h:
+        h['User-Agent'] = self.useragent
+
+      # Make request.
+      self.limiter.acquire()
+      try:
+        response = self.session.get(url, headers=h, timeout=kRequestTimeout)
+      except requests.RequestException as e:
+        if VERBOSITY > 0:
+          print(e)
+        self.limiter.backoff(attempt, type(e).__name__)
+        continue
+      self.limiter.update(response.headers)
+      if response.status_code == 200:
+        return response.json()
+
+      # IF there was an error, print it out.
+      if VERBOSITY > 0:
+        print(response)
+
+      # An expired or revoked token: authenticate again and retry.
+      if response.status_code == 401:
+        with self.auth_lock:
+          self.expiresAt = 0
+        continue
+
+      # Other client errors (e.g. 403 forbidden) generally can't be
+      # satisfied by retrying, so we don't bother.
+      if response.status_code != 429 and response.status_code < 500:
+        return None
+
+      # Honor Retry-After if the server sent one.
+      try:
+        delay = float(response.headers['Retry-After'])
+      except (KeyError, ValueError):
+        delay = None
+      self.limiter.backoff(attempt, response.status_code, delay)
+
+    return None
+
+kSecsPerDay = 60*60*24 # 86_400
+kOutDir = 'comments'
+
+# r/TheMotte is typically very slow per comment on account of its habit
+# of having threads with over 400 comments.
+kSubreddits = [
+  # 'TheMotte',
+  # 'slatestarcodex',
+  'theschism'
+]
+kLookbackDays = 14
+# Submissions crawled at once.
+kCrawlWorkers = 4
+
+def thread_path(s):
+  year = str(datetime.utcfromtimestamp(s['created_utc']).year)
+  return pjoin(kOutDir, year, s['id'] + '.json')
+
+# Crawls a submission (a listing entry) and saves its thread, merged with
+# whatever was saved before.  Returns the saved thread, or None if the crawl
+# failed.
+def crawl_submission(reddit, s, action):
+  path = thread_path(s)
+  if os.path.exists(path):
+   with open(path, 'r') as f:
+    old = json.load(f)
+  else:
+    old = {'comments': []}
+
+  submission = Submission(reddit, s['id'], order='new', expand=(action == kFull))
+  if submission.json is None:
+    return None
+
+  # We cannot consistently find all comments when there are more than
+  # 400 comments in a submission (some flaw with reddit's API?) but if
+  # we request with many different orders we can typically find (almost?)
+  # every comment.  Comments we already have (from this crawl or a
+  # previous run) aren't requested again.
+  if action == kFull and submission.json['num_comments'] > 400:
+    submission.complete(kExtraOrders, known=(c['id'] for c in old['comments']))
+
+  C = submission.comments
+  submission.comments = {}
+  for k in C:
+    submission.comments[k] = C[k].json
+
+  # Copy over old comments.
+  for c in old['comments']:
+    if c['id'] not in submission.comments:
+      submission.comments[c['id']] = c
+
+  msg = f'https://www.reddit.com{s["permalink"]} ({action}): {len(submission.comments)} out of {submission.json["num_comments"]}'
+  if VERBOSITY > 1:
+    msg += f' ({submission.fetched} comments fetched, {submission.duplicates} duplicates, {submission.num_requests} requests)'
+  print(msg)
+
+  j = submission.json
+  j['comments'] = list(submission.comments.values())
+
+  # Written to a temporary file first, so a crash can't leave a truncated
+  # thread behind.
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path + '.tmp', 'w+') as f:
+    json.dump(j, f)
+  os.replace(path + '.tmp', path)
+
+  return j
 
-    # Create headers.
-    if headers is None:
-      headers = {}
-    if 'Authorization' not in headers:
-      headers['Authorization'] = self.auth['access_token']
-    if 'User-Agent' not in headers:
-      headers['User-Agent'] = self.useragent
-
-    # Make request.
-    self.throttler.throttle()
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-      return response.json()
-
-    # IF there was an error, print it out.
-    if VERBOSITY > 0:
-      print(response)
+"""
+Crawls subreddits with a pool of worker threads.  Listing each subreddit
+and crawling each submission are separate jobs, so one huge thread only
+ever occupies one worker.  Every worker shares `reddit`, and with it one
+rate limiter, auth token and set of morechildren slots, so however many
+workers there are, only kMaxMoreChildrenInFlight morechildren requests are
+ever in flight.
+
+All the bookkeeping (crawl state, the work queue) happens on this thread.
+Submissions go into the persistent queue as they're listed and leave it
+when their crawl is recorded, and each run starts with whatever the last
+one left there.
+"""
+def crawl(reddit, state, subreddits, workers=kCrawlWorkers, full=False):
+  actions = {kFull: 0, kShallow: 0, kSkip: 0}
+  with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+    futures = {}
+    queued = set()
+
+    def submit(s):
+      if s['id'] in queued:
+        return
+      if full or not os.path.exists(thread_path(s)):
+        action = kFull
+      else:
+        action = state.action(s)
+      actions[action] += 1
+      if action == kSkip:
+        state.dequeue(s['id'])
+        return
+      queued.add(s['id'])
+      state.enqueue([s])
+      futures[executor.submit(crawl_submission, reddit, s, action)] = s
+
+    # Resume whatever the last run didn't finish.
+    for s in state.jobs():
+      submit(s)
+
+    # Grab all posts within each subreddit's time period
+    for subreddit, days in subreddits:
+      futures[executor.submit(reddit.new_submissions, subreddit, max_age=kSecsPerDay*days)] = subreddit
+
+    try:
+      while len(futures):
+        done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+          job = futures.pop(future)
+          try:
+            result = future.result()
+          except Exception as e:
+            if VERBOSITY > 0:
+              print(f'Error crawling {job if type(job) is str else job["id"]}: {e!r}')
+            continue
+          if type(job) is str:
+            # A subreddit's listing: queue its submissions.
+            for s in result:
+              submit(s)
+          elif result is not None:
+            newest = max((c.get('created_utc', 0) for c in result['comments']), default=None)
+            state.record(result, newest, time.time())
+    except KeyboardInterrupt:
+      # Unfinished jobs stay in the queue for next time.
+      executor.shutdown(wait=False, cancel_futures=True)
+      raise
+
+  return actions
+
+# "NAME" or "NAME:DAYS" -> (name, days).
+def parse_subreddit(arg, default_days):
+  name, _, days = arg.partition(':')
+  return name, float(days) if days else default_days
 
-    # Errors that are forbidden generally can't be satisfied by retrying,
-    # so we don't bother.
-    if response.status_code == 403:
-      return None
+if __name__ == '__main__':
+  argparser = argparse.ArgumentParser()
+  argparser.add_argument('subreddits', nargs='*', default=kSubreddits, help='subreddits to crawl, each optionally with its own lookback as NAME:DAYS')
+  argparser.add_argument('--days', type=float, default=kLookbackDays, help='how far back to look for submissions (default %(default)s days)')
+  argparser.add_argument('--workers', type=int, default=kCrawlWorkers, help='submissions crawled at once')
+  argparser.add_argument('--full', action='store_true', help='fully crawl every submission, even ones that look unchanged')
+  argparser.add_argument('--state', default='crawl.db', help='crawl state and work queue')
+  args = argparser.parse_args()
 
-    # Recursively retry...
-    if max_tries > 1:
-      time.sleep(3)
-      return self.request(url, max_tries - 1)
-    else:
-      return response
+  subreddits = [parse_subreddit(arg, args.days) for arg in args.subreddits]
 
-if __name__ == '__main__':
   reddit = Reddit()
 
-  kSecsPerDay = 60*60*24 # 86_400
-  kOutDir = 'comments'
-
   if not os.path.exists(kOutDir):
     os.mkdir(kOutDir)
 
-  # r/TheMotte is typically very slow per comment on account of its habit
-  # of having threads with over 400 comments.
-  for subreddit in [
-    # 'TheMotte',
-    # 'slatestarcodex',
-    'theschism'
-    ]:
-    # Grab all posts within the last time period
-    S = reddit.new_submissions(subreddit, max_age=kSecsPerDay*14)
-
-    # Grab all comments for these posts
-    for s in S:
-      fn = s['id'] + '.json'
-      year = str(datetime.utcfromtimestamp(s['created_utc']).year)
-      print('https://www.reddit.com' + s['permalink'])
-
-      submission = Submission(reddit, s['id'], order='new')
-
-      # We cannot consistently find all comments when there are more than
-      # 400 comments in a submission (some flaw with reddit's API?) but if
-      # we request with many different orders we can typically find (almost?)
-      # every comment.
-      if submission.json['num_comments'] > 400:
-        S1 = Submission(reddit, submission.id, order='new')
-        S2 = Submission(reddit, submission.id, order='old')
-        S3 = Submission(reddit, submission.id, order='top')
-        S4 = Submission(reddit, submission.id, order='controversial')
-        S5 = Submission(reddit, submission.id, order='random')
-        C = {}
-        for k in S1.comments:
-          C[k] = S1.comments[k].json
-        for k in S2.comments:
-          C[k] = S2.comments[k].json
-        for k in S3.comments:
-          C[k] = S3.comments[k].json
-        for k in S4.comments:
-          C[k] = S4.comments[k].json
-        for k in S5.comments:
-          C[k] = S5.comments[k].json
-        submission.comments = C
-      else:
-        C = submission.comments
-        submission.comments = {}
-        for k in C:
-          submission.comments[k] = C[k].json
-
-      if not os.path.exists(pjoin(kOutDir, year)):
-        os.mkdir(pjoin(kOutDir, year))
-
-      if os.path.exists(pjoin(kOutDir, year, fn)):
-       with open(pjoin(kOutDir, year, fn), 'r') as f:
-        old = json.load(f)
-      else:
-        old = {'comments': []}
-
-      # Copy over old comments.
-      for c in old['comments']:
-        if c['id'] not in submission.comments:
-          submission.comments[c['id']] = c
-
-      print(len(submission.comments), 'out of', submission.json['num_comments'])
-
-      j = submission.json
-      j['comments'] = list(submission.comments.values())
+  # What we saw last time, so unchanged submissions can be skipped.
+  state = CrawlState(args.state)
 
-      with open(pjoin(kOutDir, year, fn), 'w+') as f:
-        json.dump(j, f)
+  actions = crawl(reddit, state, subreddits, args.workers, args.full)
 
+  print(actions[kFull], 'full crawls,', actions[kShallow], 'shallow refreshes,', actions[kSkip], 'skipped')
+  if VERBOSITY > 1:
+    print('rate limiter:', json.dumps(reddit.limiter.stats()))
@@ -1,133 +1,476 @@
 from utils import *
 
-import mimetypes, re, sqlite3, sys, time
+import argparse, gzip, hashlib, json, mimetypes, os, queue, re, sqlite3, sys, threading, time, zlib
 import http.server
-import socketserver
+from email.utils import formatdate, parsedate_to_datetime
 from html.parser import HTMLParser
-from urllib.parse import unquote, urlparse, parse_qs
+from urllib.parse import unquote, urlencode, urlparse, parse_qs
 
 import pystache
+from highlight import FindAndBoldTermsHTMLParser
+from hotlists import hot_path, load_hot_lists
 from spotquery import query
+import query as sqlquery
 import spot
 
 import cgi
 
-index = spot.Index('spot-index')
+kIndexPath = 'spot-index'
+
+# Comments per streamed batch when the engine can't batch for us.
+kStreamBatchSize = 25
+
+# Set by --db to search a query.py (sqlite) index instead of spot.
+db_path = None
+
+# Each worker thread gets its own handle on the index: sqlite connections
+# can't be shared between threads, and separate handles let queries run
+# side by side.
+thread_state = threading.local()
+
+def get_index():
+  if not hasattr(thread_state, 'index'):
+    if db_path is None:
+      thread_state.index = spot.Index(kIndexPath)
+    else:
+      thread_state.index = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True).cursor()
+  return thread_state.index
 
 ext2type = mimetypes.types_map.copy()
 
-class FindAndBoldTermsHTMLParser(HTMLParser):
-  def __init__(self):
-    super().__init__()
-    self.terms = set()
-
-  def reset(self):
-    super().reset()
-    self.html = ''
-
-  def handle_starttag(self, tag, attrs):
-    r = '<' + tag
-    for key, value in attrs:
-      r += f' {key}="{value}"'
-    r += '>'
-    self.html += r
-
-  def handle_endtag(self, tag):
-    self.html += f'</{tag}>'
-
-  def handle_data(self, data):
-    for term in self.terms:
-      data = re.sub(
-        re.compile(f"[^\\w\\d]({term})[^\\w\\d]", re.IGNORECASE),
-        r" <span class='term'>\1</span> ",
-        data,
-      )
-      data = re.sub(
-        re.compile(f"^({term})[^\\w\\d]", re.IGNORECASE),
-        r"<span class='term'>\1</span> ",
-        data,
-      )
-    # self.html += cgi.escape(data)
-    self.html += data
-
-boulder = FindAndBoldTermsHTMLParser()
+# Only worth gzipping things that aren't already compressed.
+kGzipTypes = ['text/html', 'text/css', 'text/plain', 'text/javascript', 'application/javascript', 'application/json']
+
+"""
+template.html, parsed once.  In dev mode the file's mtime is checked on
+every request and the template is re-parsed when it changes.
+
+For streaming, the template is also split around its {{#comments}} section
+into a head, a per-comment item and a tail.
+"""
+class TemplateCache:
+  def __init__(self, path, reload=False):
+    self.path = path
+    self.reload = reload
+    self.lock = threading.Lock()
+    self.mtime = None
+    self.template = None
+    self.parts = None
+
+  def get(self):
+    if self.template is not None and not self.reload:
+      return self.template
+    mtime = os.path.getmtime(self.path)
+    with self.lock:
+      if mtime != self.mtime:
+        with open(self.path, 'r') as f:
+          text = f.read()
+        head, rest = text.split('{{#comments}}', 1)
+        item, tail = rest.split('{{/comments}}', 1)
+        self.template = pystache.parse(text)
+        self.parts = tuple(pystache.parse(t) for t in [head, item, tail])
+        self.mtime = mtime
+      return self.template
+
+  def get_parts(self):
+    self.get()
+    return self.parts
+
+class StaticFile:
+  def __init__(self, path):
+    with open(path, 'rb') as f:
+      self.data = f.read()
+    self.mtime = os.path.getmtime(path)
+    self.content_type = ext2type.get(os.path.splitext(path)[1], 'application/octet-stream')
+    self.etag = '"' + hashlib.sha1(self.data).hexdigest()[:16] + '"'
+    self.last_modified = formatdate(self.mtime, usegmt=True)
+    if self.content_type in kGzipTypes:
+      self.gzipped = gzip.compress(self.data)
+    else:
+      self.gzipped = None
+
+# The only files servefile serves.  Everything else in the working
+# directory (the indexes, crawl state, API credentials) stays private.
+kStaticFiles = ['uparrow.png']
+
+"""
+Static files held in memory.  Only `paths` are served, so the cache holds
+at most those files.  Like TemplateCache, files are re-read when their
+mtime changes only in dev mode.
+"""
+class StaticCache:
+  def __init__(self, paths, reload=False):
+    self.paths = frozenset(paths)
+    self.reload = reload
+    self.lock = threading.Lock()
+    self.files = {}
+
+  # Returns None if the file isn't one of `paths` or doesn't exist.
+  def get(self, path):
+    if path not in self.paths:
+      return None
+    f = self.files.get(path)
+    if f is not None and not self.reload:
+      return f
+    try:
+      if f is not None and os.path.getmtime(path) == f.mtime:
+        return f
+      f = StaticFile(path)
+    except IOError:
+      return None
+    with self.lock:
+      self.files[path] = f
+    return f
+
+template = TemplateCache('template.html')
+static_files = StaticCache(kStaticFiles)
+
+"""
+spot's results, shaped like a query.CommentPage: batches of at most
+page_size comments, and whether there were more.  spot can't resume a
+search, so there's never a next page.
+"""
+class SpotPage:
+  def __init__(self, comments, page_size):
+    self.more = len(comments) > page_size
+    self.next = None
+    comments = comments[:page_size]
+    self.batches = [comments[i:i + kStreamBatchSize] for i in range(0, len(comments), kStreamBatchSize)]
+
+  def __iter__(self):
+    return iter(self.batches)
 
 class MyServer(http.server.BaseHTTPRequestHandler):
+  # Keep-alive needs HTTP/1.1 (and a Content-Length on every response);
+  # `timeout` closes idle connections so they don't pin a worker forever.
+  protocol_version = 'HTTP/1.1'
+  timeout = 5
+  use_gzip = False
+  stream = False
+
   def do_GET(self):
     if self.path[:7] == '/search':
       args = parse_qs(urlparse(self.path).query)
       self.search(args)
+    elif urlparse(self.path).path == '/stats':
+      self.stats()
     else:
       self.servefile()
   
+  def accepts_gzip(self):
+    return self.use_gzip and 'gzip' in self.headers.get('Accept-Encoding', '')
+
+  # Sends a complete response, gzipping it if the client allows it.
+  def send_body(self, data, content_type, headers=(), gzipped=None):
+    if self.accepts_gzip() and content_type in kGzipTypes:
+      data = gzip.compress(data) if gzipped is None else gzipped
+      headers = list(headers) + [('Content-Encoding', 'gzip')]
+    self.send_response(200)
+    self.send_header('Content-type', content_type)
+    self.send_header('Content-Length', str(len(data)))
+    if self.use_gzip:
+      self.send_header('Vary', 'Accept-Encoding')
+    for key, value in headers:
+      self.send_header(key, value)
+    self.end_headers()
+    self.wfile.write(data)
+
+  def not_modified(self, f):
+    if 'If-None-Match' in self.headers:
+      return f.etag in [t.strip() for t in self.headers['If-None-Match'].split(',')]
+    if 'If-Modified-Since' in self.headers:
+      try:
+        since = parsedate_to_datetime(self.headers['If-Modified-Since']).timestamp()
+      except (TypeError, ValueError):
+        return False
+      return int(f.mtime) <= since
+    return False
+
   def servefile(self):
-    path = self.path[1:]
-    try:
-      f = open(path, 'rb')
-    except IOError:
+    path = urlparse(self.path).path[1:]
+    f = static_files.get(path)
+    if f is None:
       self.send_error(404, 'File not found')
       return
-    self.send_response(200)
-    # self.send_header('Content-type', 'image/png')
-    self.send_header('Content-type', ext2type['.' + self.path.split('.')[-1]])
-    self.end_headers()
-    self.wfile.write(f.read())
-    f.close()
+    if self.not_modified(f):
+      self.send_response(304)
+      self.send_header('ETag', f.etag)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+    self.send_body(f.data, f.content_type, headers=[
+      ('ETag', f.etag),
+      ('Last-Modified', f.last_modified),
+    ], gzipped=f.gzipped)
+
+  # Cache hit ratios, as JSON.
+  def stats(self):
+    R = {}
+    if db_path is not None:
+      R['results'] = sqlquery.result_cache.stats()
+      R['comments'] = sqlquery.comment_cache.stats()
+    self.send_body(json.dumps(R, indent=2).encode(), 'application/json', headers=[('Cache-Control', 'no-store')])
+
+  # Returns (tokens, page of comments), or an error message.  The page is
+  # a query.CommentPage or a SpotPage.
+  def run_search(self, query_text, page_size, order='score', after=None):
+    index = get_index()
+    if db_path is not None:
+      try:
+        tokens, plan = sqlquery.parse_query(index, query_text, order)
+        page = sqlquery.CommentPage(index, plan, page_size=page_size, after=after)
+        if after is not None:
+          # Check the token now rather than halfway through the page.
+          sqlquery.resume_point(plan, after)
+      except ValueError as e:
+        return str(e)
+      print(plan.explain())
+      return tokens, page
+
+    if order != 'score':
+      return f'sorting by "{order}" needs a sqlite index (--db)'
+    if after is not None:
+      return 'paging needs a sqlite index (--db)'
+    query_result = query(index, query_text, max_results=page_size + 1)
+    if type(query_result) is str:
+      return query_result
+    return query_result['tokens'], SpotPage(query_result['comments'], page_size)
+
+  # Fills in everything the template needs that depends on the query.
+  def prepare_comments(self, comments, first_idx, parser, boulder):
+    for i, comment in enumerate(comments):
+      comment['idx'] = first_idx + i
+      if 'body_render' in comment:
+        body = comment['body_render']
+      else:
+        # Indexed before display fields were precomputed.
+        tokens = comment["tokens"].split(' ')
+        tokens = [t for t in tokens if t[:8] == 'pauthor:']
+        if len(tokens) > 0:
+          comment["pauthor"] = tokens[0][8:]
+        comment['subreddit'] = 'slatestarcodex' if 'slatestarcodex' in comment['permalink'] else 'TheMotte'
+        parser.reset()
+        parser.feed(comment["body_html"])
+        body = parser.alltext
+
+      boulder.reset()
+      boulder.feed(body)
+      comment['body_html'] = boulder.html
+
+  def highlighter(self, tokens):
+    terms = set([t for t in tokens if (':' not in t) and (t not in '()+')])
+    print('tokens', terms)
+    return FindAndBoldTermsHTMLParser(terms)
 
   def search(self, args):
     start_time = time.time()
     print(f'search {args}')
     query_text = ' ' + unquote(args.get('query', [''])[0])
 
+    # page_size is the number of results per page (max_results is its
+    # old name).
     try:
-      max_results = int(args["max_results"][0])
+      page_size = int(args.get('page_size', args.get('max_results'))[0])
     except:
-      max_results = 100
-
-    query_result = query(index, query_text, max_results = max_results+1)
-    if type(query_result) is str:
-      self.send_error(500, query_result)
+      page_size = 100
+    if page_size < 1:
+      self.send_error(400, 'page_size must be positive')
       return
+    order = args.get('order', ['score'])[0]
+    after = args.get('after', [None])[0]
+    offset = 0
+    if after is not None:
+      try:
+        offset = sqlquery.parse_continuation(after)[2]
+      except ValueError as e:
+        self.send_error(400, str(e))
+        return
 
-    for comment in query_result['comments']:
-      tokens = comment["tokens"].split(' ')
-      tokens = [t for t in tokens if t[:8] == 'pauthor:']
-      if len(tokens) > 0:
-        comment["pauthor"] = tokens[0][8:]
+    if self.stream:
+      self.stream_search(query_text, page_size, start_time, order, after, offset)
+      return
 
-    tokens = query_result['tokens']
+    r = self.run_search(query_text, page_size, order, after)
+    if type(r) is str:
+      self.send_error(500, r)
+      return
+    tokens, page = r
 
     parser = MyHTMLParser()
+    boulder = self.highlighter(tokens)
+    comments = []
+    for batch in page:
+      self.prepare_comments(batch, offset + len(comments) + 1, parser, boulder)
+      comments += batch
 
-    boulder.terms = set([t for t in tokens if (':' not in t) and (t not in '()+')])
-    print('tokens' ,boulder.terms)
-    for i in range(len(query_result['comments'])):
-      comment = query_result['comments'][i]
-      comment['subreddit'] = 'slatestarcodex' if 'slatestarcodex' in comment['permalink'] else 'TheMotte'
-      comment['idx'] = i + 1
-      parser.reset()
-      parser.feed(comment["body_html"])
-
-      boulder.reset()
-      boulder.feed(parser.alltext)
-      comment['body_html'] = boulder.html
-
-    with open('template.html', 'r') as f:
-      text = f.read()
+    next_url = None if page.next is None else self.next_page_url(args, page.next)
     dt = time.time() - start_time
-    msg = f'Over {max_results} results in %.3f seconds' % dt if len(query_result['comments']) == max_results + 1 else f'{len(query_result["comments"])} results in %.3f seconds' % dt
-    result = pystache.render(text, {
-      'comments': query_result['comments'],
-      'num_results_msg': msg
+    msg = f'Over {offset + page_size} results in %.3f seconds' % dt if page.more else f'{offset + len(comments)} results in %.3f seconds' % dt
+    result = pystache.render(template.get(), {
+      'comments': comments,
+      'num_results_msg': msg,
+      'next_url': next_url,
     })
+    self.send_body(result.encode(), 'text/html')
+
+  def next_page_url(self, args, after):
+    # Carry the page size over under its current name.
+    page_size = args.get('page_size', args.get('max_results'))
+    args = {key: values[0] for key, values in args.items() if key not in ('max_results', 'page_size')}
+    if page_size is not None:
+      args['page_size'] = page_size[0]
+    args['after'] = after
+    return './search?' + urlencode(args)
+
+  def begin_stream(self, content_type):
+    # Chunked encoding is HTTP/1.1 only; older clients get the body until
+    # we close the connection.
+    self.chunked = (self.request_version == 'HTTP/1.1' and self.protocol_version == 'HTTP/1.1')
+    self.compressor = zlib.compressobj(wbits=31) if self.accepts_gzip() else None
     self.send_response(200)
-    self.send_header("Content-type", "text/html")
+    self.send_header('Content-type', content_type)
+    if self.compressor is not None:
+      self.send_header('Content-Encoding', 'gzip')
+    if self.use_gzip:
+      self.send_header('Vary', 'Accept-Encoding')
+    if self.chunked:
+      self.send_header('Transfer-Encoding', 'chunked')
+    else:
+      self.send_header('Connection', 'close')
+      self.close_connection = True
     self.end_headers()
-    self.wfile.write(result.encode())
 
-PORT = int(sys.argv[1])
+  def _write_raw(self, data):
+    if len(data) == 0:
+      # An empty chunk would end the response.
+      return
+    if self.chunked:
+      self.wfile.write(b'%x\r\n' % len(data) + data + b'\r\n')
+    else:
+      self.wfile.write(data)
+    self.wfile.flush()
+
+  def write_chunk(self, data):
+    if self.compressor is not None:
+      data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+    self._write_raw(data)
+
+  def end_stream(self):
+    if self.compressor is not None:
+      self._write_raw(self.compressor.flush())
+    if self.chunked:
+      self.wfile.write(b'0\r\n\r\n')
+
+  """
+  Sends the page head immediately, then each batch of results as soon as
+  the engine produces it.  The result count (with time to first result) is
+  filled in by a script at the end, since it isn't known up front.
+  """
+  def stream_search(self, query_text, page_size, start_time, order='score', after=None, offset=0):
+    head, item, tail = template.get_parts()
+    self.begin_stream('text/html')
+    self.write_chunk(pystache.render(head, {
+      'comments': '[]',
+      'num_results_msg': 'Searching...',
+    }).encode())
+
+    next_url = None
+    r = self.run_search(query_text, page_size, order, after)
+    if type(r) is str:
+      msg = r
+    else:
+      tokens, page = r
+      parser = MyHTMLParser()
+      boulder = self.highlighter(tokens)
+      num_results = 0
+      first_result_time = None
+      for batch in page:
+        if first_result_time is None and len(batch) > 0:
+          first_result_time = time.time() - start_time
+        self.prepare_comments(batch, offset + num_results + 1, parser, boulder)
+        num_results += len(batch)
+        self.write_chunk(''.join(pystache.render(item, comment) for comment in batch).encode())
+
+      dt = time.time() - start_time
+      if page.next is not None:
+        next_url = self.next_page_url(parse_qs(urlparse(self.path).query), page.next)
+      if page.more:
+        msg = f'Over {offset + page_size} results in %.3f seconds' % dt
+      else:
+        msg = f'{offset + num_results} results in %.3f seconds' % dt
+      if first_result_time is not None:
+        msg += ' (first result after %.3f seconds)' % first_result_time
+
+    self.write_chunk(f'<script>numResultsMsg.innerText = {json.dumps(msg)};</script>'.encode())
+    self.write_chunk(pystache.render(tail, {'next_url': next_url}).encode())
+    self.end_stream()
+
+"""
+An HTTP server with a fixed pool of worker threads.
+
+Accepted connections wait in a bounded queue until a worker is free; when
+the queue is full the connection is turned away with a 503 rather than
+piling up behind slow searches.
+"""
+class PooledHTTPServer(http.server.HTTPServer):
+  def __init__(self, address, handler, workers=8, max_queue=64):
+    super().__init__(address, handler)
+    self.requests = queue.Queue(maxsize=max_queue)
+    self.workers = [
+      threading.Thread(target=self._work, daemon=True) for _ in range(workers)
+    ]
+    for worker in self.workers:
+      worker.start()
+
+  def process_request(self, request, client_address):
+    try:
+      self.requests.put_nowait((request, client_address))
+    except queue.Full:
+      try:
+        request.sendall(b'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+      except OSError:
+        pass
+      self.shutdown_request(request)
+
+  def _work(self):
+    while True:
+      request, client_address = self.requests.get()
+      try:
+        self.finish_request(request, client_address)
+      except Exception:
+        self.handle_error(request, client_address)
+      finally:
+        self.shutdown_request(request)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('port', type=int)
+  parser.add_argument('--workers', type=int, default=8, help='number of request-handling threads')
+  parser.add_argument('--queue', type=int, default=64, help='connections allowed to wait for a worker')
+  parser.add_argument('--keepalive', type=float, default=5, help='seconds an idle connection is kept open (0 disables keep-alive)')
+  parser.add_argument('--gzip', action='store_true', help='gzip responses for clients that accept it')
+  parser.add_argument('--dev', action='store_true', help='reload the template and static files when they change')
+  parser.add_argument('--stream', action='store_true', help='stream search results as they are found')
+  parser.add_argument('--db', help='search this sqlite index (see query.py) instead of spot-index')
+  args = parser.parse_args()
+
+  db_path = args.db
+  if db_path is not None:
+    # Map the hot posting lists now rather than on the first query.
+    hot = load_hot_lists(hot_path(db_path))
+    if hot is not None:
+      print(f'{len(hot)} hot posting lists ({hot.num_postings()} postings) mapped from {hot_path(db_path)}')
+  MyServer.use_gzip = args.gzip
+  MyServer.stream = args.stream
+  template.reload = args.dev
+  static_files.reload = args.dev
+
+  if args.keepalive > 0:
+    MyServer.timeout = args.keepalive
+  else:
+    MyServer.protocol_version = 'HTTP/1.0'
 
-with socketserver.TCPServer(("", PORT), MyServer) as httpd:
-  print(f'serving @ {PORT}')
-  httpd.serve_forever()
+  with PooledHTTPServer(("", args.port), MyServer, workers=args.workers, max_queue=args.queue) as httpd:
+    print(f'serving @ {args.port} with {args.workers} workers')
+    httpd.serve_forever()
 
@@ -0,0 +1,628 @@
+"""
+Writer for the sqlite index that query.py searches.
+
+Tables:
+
+  tokens       one row per (token_hash, -score, comment_id) posting.  Every
+               comment also gets a token_hash=0 row (see query.token_hash).
+  comments     comment_id -> the comment's JSON.
+  token_stats  token_hash -> number of comments containing it.
+  files        thread file -> (mtime, size, sha1) when it was last indexed.
+  versions     comment_id -> (thread file, hash of the indexed JSON).
+  meta         key -> value; "hash" names the token hash scheme (see
+               utils.kHashSchemes).  Indexes without it use "sha256".
+               "postings" is "blocks" if the index has been packed.
+               "version" counts the commits that changed the index, so
+               readers know when cached results are stale.
+  posting_blocks
+               (token_hash, last posting) -> delta+varint encoded block of
+               postings (see blocks.py).  A packed index keeps its postings
+               here and leaves "tokens" empty.
+  comment_attrs
+               comment_id -> its posting's comment_score and the numeric
+               fields query.py can filter on by range (kAttributes), with
+               a (field, comment_score, comment_id) index per field, and
+               (comment_score, comment_id) and (created_utc, comment_id)
+               indexes for walking it in posting order.
+  time_tokens  optional; the postings again, as (token_hash, created_utc,
+               comment_id), so results can be listed newest or oldest
+               first (see query.kOrderings).
+
+The last two let build_index.py update the index incrementally: only
+changed thread files are re-read and only changed comments rewritten.
+
+The most frequent tokens' postings can also be kept in a memory-mapped
+file next to the index (see hotlists.py).  Once it exists it's rebuilt
+whenever the index changes.
+"""
+
+import argparse, hashlib, json, os, sqlite3, threading
+
+from blocks import decode_block, encode_blocks, kBlockSize
+from hotlists import hot_path, kHotListSize, load_hot_lists, write_hot_lists
+from utils import Hash64, hashfn, kDefaultHashScheme
+
+# Postings are buffered and written with executemany in batches this big.
+kInsertBatchSize = 50000
+
+def create_tables(sql_cursor):
+  sql_cursor.execute("""
+    CREATE TABLE IF NOT EXISTS tokens (
+      token_hash INTEGER,
+      comment_score INTEGER,
+      comment_id INTEGER
+    )""")
+  sql_cursor.execute("""
+    CREATE TABLE IF NOT EXISTS comments (
+      comment_id INTEGER PRIMARY KEY,
+      json TEXT
+    )""")
+  sql_cursor.execute("""
+    CREATE TABLE IF NOT EXISTS files (
+      path TEXT PRIMARY KEY,
+      mtime REAL,
+      size INTEGER,
+      sha1 TEXT
+    )""")
+  sql_cursor.execute("""
+    CREATE TABLE IF NOT EXISTS versions (
+      comment_id INTEGER PRIMARY KEY,
+      path TEXT,
+      version TEXT
+    )""")
+  sql_cursor.execute("CREATE INDEX IF NOT EXISTS versions_path ON versions(path)")
+  sql_cursor.execute("""
+    CREATE TABLE IF NOT EXISTS meta (
+      key TEXT PRIMARY KEY,
+      value TEXT
+    )""")
+  sql_cursor.execute("""
+    CREATE TABLE IF NOT EXISTS posting_blocks (
+      token_hash INTEGER,
+      last_score INTEGER,
+      last_id INTEGER,
+      data BLOB,
+      PRIMARY KEY (token_hash, last_score, last_id)
+    ) WITHOUT ROWID""")
+
+# Numeric fields range filters can use.  pscore, gscore and depth come from
+# the comment's tokens; they're NULL when the token is missing (e.g. a
+# top-level comment has no pscore).
+kAttributes = ['score', 'pscore', 'gscore', 'depth', 'created_utc']
+kTokenAttributes = ['pscore', 'gscore', 'depth']
+kInsertAttributes = f"INSERT INTO comment_attrs VALUES ({', '.join('?' * (len(kAttributes) + 2))})"
+
+def comment_attributes(id_, tokens, comment):
+  R = {'score': comment['score'], 'created_utc': int(comment['created_utc'])}
+  for token in tokens:
+    field, _, value = token.partition(':')
+    if field in kTokenAttributes:
+      R[field] = int(value)
+  return (id_, -comment['score']) + tuple(R.get(field) for field in kAttributes)
+
+# Creates and indexes comment_attrs, backfilling it from the stored comments
+# if it's empty (i.e. the index predates it).
+def ensure_attributes(sql_cursor):
+  sql_cursor.execute(f"""
+    CREATE TABLE IF NOT EXISTS comment_attrs (
+      comment_id INTEGER PRIMARY KEY,
+      comment_score INTEGER,
+      {', '.join(f'{field} INTEGER' for field in kAttributes)}
+    )""")
+  for field in kAttributes:
+    sql_cursor.execute(f"""
+      CREATE INDEX IF NOT EXISTS attrs_{field}
+      ON comment_attrs({field}, comment_score, comment_id)""")
+  # For ranges too wide to merge one value at a time (see
+  # query.range_iterator).
+  sql_cursor.execute("CREATE INDEX IF NOT EXISTS attrs_posting ON comment_attrs(comment_score, comment_id)")
+  sql_cursor.execute("CREATE INDEX IF NOT EXISTS attrs_time ON comment_attrs(created_utc, comment_id)")
+  if sql_cursor.execute("SELECT 1 FROM comment_attrs LIMIT 1").fetchone() is not None:
+    return
+  rows = []
+  for comment_id, text in sql_cursor.connection.execute("SELECT comment_id, json FROM comments"):
+    comment = json.loads(text)
+    rows.append(comment_attributes(comment_id, comment['tokens'].split(' '), comment))
+  sql_cursor.executemany(kInsertAttributes, rows)
+
+def ensure_indices(sql_cursor):
+  # Covering index for posting-list scans: every PostingCursor query is a
+  # seek on token_hash followed by an in-order walk of (score, id).
+  sql_cursor.execute("""
+    CREATE INDEX IF NOT EXISTS tokens_hash_score_id
+    ON tokens(token_hash, comment_score, comment_id)""")
+
+def ensure_token_stats(sql_cursor):
+  sql_cursor.execute("""
+    CREATE TABLE IF NOT EXISTS token_stats (
+      token_hash INTEGER PRIMARY KEY,
+      doc_freq INTEGER
+    )""")
+  if sql_cursor.execute("SELECT 1 FROM token_stats LIMIT 1").fetchone() is None:
+    sql_cursor.execute("""
+      INSERT INTO token_stats
+      SELECT token_hash, COUNT(*) FROM tokens GROUP BY token_hash""")
+
+def comment_version(comment):
+  return hashlib.sha1(json.dumps(comment, sort_keys=True).encode()).hexdigest()
+
+def file_sha1(path):
+  with open(path, 'rb') as f:
+    return hashlib.sha1(f.read()).hexdigest()
+
+def hash_scheme(sql_cursor):
+  try:
+    r = sql_cursor.execute("SELECT value FROM meta WHERE key='hash'").fetchone()
+  except sqlite3.OperationalError:
+    r = None
+  return 'sha256' if r is None else r[0]
+
+index_versions = {}  # connection -> the version index_version last read
+index_hashfns = {}
+index_formats = {}
+index_hashfns_lock = threading.Lock()
+
+def index_version(sql_cursor):
+  try:
+    r = sql_cursor.execute("SELECT value FROM meta WHERE key='version'").fetchone()
+  except sqlite3.OperationalError:
+    r = None
+  version = 0 if r is None else int(r[0])
+  with index_hashfns_lock:
+    index_versions[sql_cursor.connection] = version
+  return version
+
+# Marks the index as changed, so readers drop what they've cached from it.
+def bump_version(sql_cursor):
+  sql_cursor.execute("""
+    INSERT INTO meta VALUES ('version', 1)
+    ON CONFLICT(key) DO UPDATE SET value=value+1""")
+
+# Returns read(sql_cursor), cached per connection until index_version next
+# reads a different version on it (readers read it once per query, so e.g.
+# sqlindex.py --rehash under a running server is picked up by the next
+# query).
+def cached_per_version(sql_cursor, cache, read):
+  conn = sql_cursor.connection
+  version = index_versions.get(conn)
+  entry = cache.get(conn)
+  if entry is None or entry[0] != version:
+    entry = (version, read(sql_cursor))
+    with index_hashfns_lock:
+      cache[conn] = entry
+  return entry[1]
+
+# The token hash function the index behind `sql_cursor` was built with.
+def index_hashfn(sql_cursor):
+  def read(sql_cursor):
+    scheme = hash_scheme(sql_cursor)
+    return hashfn if scheme == kDefaultHashScheme else Hash64(scheme)
+  return cached_per_version(sql_cursor, index_hashfns, read)
+
+def posting_format(sql_cursor):
+  try:
+    r = sql_cursor.execute("SELECT value FROM meta WHERE key='postings'").fetchone()
+  except sqlite3.OperationalError:
+    r = None
+  return 'rows' if r is None else r[0]
+
+# "blocks" if the index behind `sql_cursor` is packed, otherwise "rows".
+def index_posting_format(sql_cursor):
+  return cached_per_version(sql_cursor, index_formats, posting_format)
+
+index_paths = {}
+
+# The file behind `sql_cursor` ('' for in-memory databases).
+def index_path(sql_cursor):
+  conn = sql_cursor.connection
+  if conn not in index_paths:
+    path = next(r[2] for r in sql_cursor.execute("PRAGMA database_list") if r[1] == 'main')
+    with index_hashfns_lock:
+      index_paths[conn] = path
+  return index_paths[conn]
+
+index_hot = {}
+
+# The HotLists for the index behind `sql_cursor`, or None if there aren't
+# any or they were built from another version of the index (e.g. a commit
+# hasn't rebuilt them yet), in which case postings are read from sqlite.
+# Like index_hashfn they're cached per version, so probing a hot list is
+# just a binary search; a miss isn't cached, since the lists for this
+# version may still be being written.
+def index_hot_lists(sql_cursor):
+  conn = sql_cursor.connection
+  version = index_versions.get(conn)
+  if version is None:
+    version = index_version(sql_cursor)
+  entry = index_hot.get(conn)
+  if entry is not None and entry[0] == version:
+    return entry[1]
+  path = index_path(sql_cursor)
+  if not path:
+    return None
+  hot = load_hot_lists(hot_path(path))
+  if hot is None or hot.version != version:
+    return None
+  with index_hashfns_lock:
+    index_hot[conn] = (version, hot)
+  return hot
+
+def postings(id_, tokens, score, fn=hashfn):
+  R = [(0, -score, id_)]
+  for token in tokens:
+    R.append((fn(token), -score, id_))
+  return R
+
+def time_postings(id_, tokens, created_utc, fn=hashfn):
+  created_utc = int(created_utc)
+  R = [(0, created_utc, id_)]
+  for token in tokens:
+    R.append((fn(token), created_utc, id_))
+  return R
+
+def has_time_order(sql_cursor):
+  return sql_cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='time_tokens'").fetchone() is not None
+
+# (Re)builds time_tokens from the stored comments.
+def build_time_order(sql_cursor):
+  fn = Hash64(hash_scheme(sql_cursor))
+  sql_cursor.execute("DROP TABLE IF EXISTS time_tokens")
+  sql_cursor.execute("""
+    CREATE TABLE time_tokens (
+      token_hash INTEGER,
+      created_utc INTEGER,
+      comment_id INTEGER
+    )""")
+  rows = []
+  for comment_id, text in sql_cursor.connection.execute("SELECT comment_id, json FROM comments"):
+    comment = json.loads(text)
+    rows += time_postings(comment_id, comment['tokens'].split(' '), comment['created_utc'], fn)
+    if len(rows) >= kInsertBatchSize:
+      sql_cursor.executemany("INSERT INTO time_tokens VALUES (?, ?, ?)", rows)
+      rows = []
+  sql_cursor.executemany("INSERT INTO time_tokens VALUES (?, ?, ?)", rows)
+  sql_cursor.execute("""
+    CREATE INDEX time_tokens_hash_created_id
+    ON time_tokens(token_hash, created_utc, comment_id)""")
+
+"""
+Re-hashes every posting with `scheme`.  Hashes can't be inverted, so the
+postings are rebuilt from the tokens stored with each comment.
+"""
+def rehash(sql_cursor, scheme=kDefaultHashScheme):
+  fn = Hash64(scheme)
+  sql_cursor.execute("DELETE FROM tokens")
+  sql_cursor.execute("DROP TABLE IF EXISTS token_stats")
+  rows = []
+  for comment_id, text in sql_cursor.connection.execute("SELECT comment_id, json FROM comments"):
+    comment = json.loads(text)
+    rows += postings(comment_id, comment['tokens'].split(' '), comment['score'], fn)
+    if len(rows) >= kInsertBatchSize:
+      sql_cursor.executemany("INSERT INTO tokens VALUES (?, ?, ?)", rows)
+      rows = []
+  sql_cursor.executemany("INSERT INTO tokens VALUES (?, ?, ?)", rows)
+  sql_cursor.execute("INSERT OR REPLACE INTO meta VALUES ('hash', ?)", (scheme,))
+  ensure_token_stats(sql_cursor)
+  if posting_format(sql_cursor) == 'blocks':
+    pack_postings(sql_cursor)
+  if has_time_order(sql_cursor):
+    build_time_order(sql_cursor)
+
+"""
+Moves every posting from "tokens" into delta+varint encoded blocks in
+"posting_blocks".  The packed index is much smaller and faster to scan;
+SqlIndex keeps it packed, updating only the blocks that change (see
+update_blocks).
+"""
+def pack_postings(sql_cursor, block_size=kBlockSize):
+  ensure_indices(sql_cursor)
+  # The stats are computed from "tokens", so they have to exist first.
+  ensure_token_stats(sql_cursor)
+  sql_cursor.execute("DELETE FROM posting_blocks")
+  rows = []
+  def add(token, postings):
+    for last, data in encode_blocks(postings, block_size):
+      rows.append((token, last[0], last[1], data))
+  token, postings = None, []
+  for token_hash, score, id_ in sql_cursor.connection.execute("""
+      SELECT token_hash, comment_score, comment_id
+      FROM tokens
+      ORDER BY token_hash, comment_score, comment_id"""):
+    if token_hash != token:
+      add(token, postings)
+      token, postings = token_hash, []
+    postings.append((score, id_))
+    if len(rows) >= kInsertBatchSize // block_size:
+      sql_cursor.executemany("INSERT INTO posting_blocks VALUES (?, ?, ?, ?)", rows)
+      rows = []
+  add(token, postings)
+  sql_cursor.executemany("INSERT INTO posting_blocks VALUES (?, ?, ?, ?)", rows)
+  sql_cursor.execute("DELETE FROM tokens")
+  sql_cursor.execute("INSERT OR REPLACE INTO meta VALUES ('postings', 'blocks')")
+
+def unpack_postings(sql_cursor):
+  rows = []
+  for token_hash, data in sql_cursor.connection.execute("SELECT token_hash, data FROM posting_blocks"):
+    rows += [(token_hash, score, id_) for score, id_ in decode_block(data)]
+    if len(rows) >= kInsertBatchSize:
+      sql_cursor.executemany("INSERT INTO tokens VALUES (?, ?, ?)", rows)
+      rows = []
+  sql_cursor.executemany("INSERT INTO tokens VALUES (?, ?, ?)", rows)
+  sql_cursor.execute("DELETE FROM posting_blocks")
+  sql_cursor.execute("DELETE FROM meta WHERE key='postings'")
+
+"""
+Applies `changes`, {(token_hash, comment_score, comment_id): whether the
+posting is present}, to a packed index.  A posting belongs to the first of
+its token's blocks whose last posting is >= it (or to the last block), so
+only those blocks are decoded and re-encoded; one that grows past
+block_size is split, and one left empty is dropped.
+"""
+def update_blocks(sql_cursor, changes, block_size=kBlockSize):
+  by_token = {}
+  for (token_hash, score, id_), present in changes.items():
+    by_token.setdefault(token_hash, []).append(((score, id_), present))
+  for token_hash, L in by_token.items():
+    L.sort()
+    i = 0
+    while i < len(L):
+      r = sql_cursor.execute("""
+        SELECT last_score, last_id, data FROM posting_blocks
+        WHERE token_hash=? AND (last_score, last_id) >= (?, ?)
+        ORDER BY last_score, last_id
+        LIMIT 1""", (token_hash,) + L[i][0]).fetchone()
+      if r is None:
+        # Past the end of the list: extend its last block.
+        r = sql_cursor.execute("""
+          SELECT last_score, last_id, data FROM posting_blocks
+          WHERE token_hash=?
+          ORDER BY last_score DESC, last_id DESC
+          LIMIT 1""", (token_hash,)).fetchone()
+        j = len(L)
+      else:
+        j = i
+        while j < len(L) and L[j][0] <= (r[0], r[1]):
+          j += 1
+      postings = set() if r is None else set(decode_block(r[2]))
+      for posting, present in L[i:j]:
+        if present:
+          postings.add(posting)
+        else:
+          postings.discard(posting)
+      if r is not None:
+        sql_cursor.execute("""
+          DELETE FROM posting_blocks
+          WHERE token_hash=? AND last_score=? AND last_id=?""", (token_hash, r[0], r[1]))
+      sql_cursor.executemany("INSERT INTO posting_blocks VALUES (?, ?, ?, ?)", [
+        (token_hash, last[0], last[1], data) for last, data in encode_blocks(sorted(postings), block_size)
+      ])
+      i = j
+
+# Returns a token's postings in order, whichever format the index is in.
+def read_postings(sql_cursor, token_hash):
+  if posting_format(sql_cursor) == 'blocks':
+    R = []
+    for (data,) in sql_cursor.execute("""
+        SELECT data FROM posting_blocks
+        WHERE token_hash=?
+        ORDER BY last_score, last_id""", (token_hash,)).fetchall():
+      R += decode_block(data)
+    return R
+  return sql_cursor.execute("""
+    SELECT comment_score, comment_id FROM tokens
+    WHERE token_hash=?
+    ORDER BY comment_score, comment_id""", (token_hash,)).fetchall()
+
+# Writes the `top` most frequent tokens' postings to `path` (see hotlists.py).
+def build_hot_lists(sql_cursor, path, top=kHotListSize):
+  ensure_token_stats(sql_cursor)
+  hashes = [r[0] for r in sql_cursor.execute("""
+    SELECT token_hash FROM token_stats
+    WHERE token_hash != 0
+    ORDER BY doc_freq DESC
+    LIMIT ?""", (top,)).fetchall()]
+  write_hot_lists(path, ((h, read_postings(sql_cursor, h)) for h in hashes), top, index_version(sql_cursor))
+
+class SqlIndex:
+  def __init__(self, path):
+    self.path = path
+    self.conn = sqlite3.connect(path)
+    self.c = self.conn.cursor()
+    self.rows = []
+    self.time_rows = []
+    # Posting changes waiting for update_blocks, if the index is packed.
+    self.changes = {}
+    # Whether inserts/deletes keep token_stats up to date.  A fresh build
+    # computes the stats in one pass at the end instead.
+    self.maintain_stats = True
+    create_tables(self.c)
+    # Whether the postings are in blocks now, and whether to pack them when
+    # the index is finished (a packed index stays packed).
+    self.blocks = posting_format(self.c) == 'blocks'
+    self.packed = self.blocks
+    # Whether create_indices packed the postings, leaving pages to give back.
+    self.repacked = False
+    ensure_token_stats(self.c)
+    ensure_attributes(self.c)
+    self.time_order = has_time_order(self.c)
+    self.hashfn = Hash64(hash_scheme(self.c))
+
+  @staticmethod
+  def create(path):
+    if os.path.exists(path):
+      os.remove(path)
+    index = SqlIndex(path)
+    index.c.execute("INSERT INTO meta VALUES ('hash', ?)", (kDefaultHashScheme,))
+    index.hashfn = hashfn
+    index.maintain_stats = False
+    return index
+
+  def _flush_rows(self):
+    if len(self.rows) == 0:
+      return
+    if self.blocks:
+      for r in self.rows:
+        self.changes[r] = True
+    else:
+      self.c.executemany("INSERT INTO tokens VALUES (?, ?, ?)", self.rows)
+    if self.maintain_stats:
+      self.c.executemany("""
+        INSERT INTO token_stats VALUES (?, 1)
+        ON CONFLICT(token_hash) DO UPDATE SET doc_freq=doc_freq+1""", [(r[0],) for r in self.rows])
+    self.rows = []
+    if self.time_order:
+      self.c.executemany("INSERT INTO time_tokens VALUES (?, ?, ?)", self.time_rows)
+      self.time_rows = []
+    if len(self.changes) >= kInsertBatchSize:
+      self._flush_changes()
+
+  def _flush_changes(self):
+    update_blocks(self.c, self.changes)
+    self.changes = {}
+
+  def _flush(self):
+    self._flush_rows()
+    self._flush_changes()
+
+  # `path` is the thread file the comment came from; it (and the comment's
+  # version) are recorded for incremental updates.
+  def insert(self, id_, tokens, comment, path=None, version=None):
+    self.c.execute("INSERT INTO comments VALUES (?, ?)", (id_, json.dumps(comment)))
+    self.c.execute(kInsertAttributes, comment_attributes(id_, tokens, comment))
+    self.rows += postings(id_, tokens, comment['score'], self.hashfn)
+    if self.time_order:
+      self.time_rows += time_postings(id_, tokens, comment['created_utc'], self.hashfn)
+    if path is not None:
+      if version is None:
+        version = comment_version(comment)
+      self.c.execute("INSERT OR REPLACE INTO versions VALUES (?, ?, ?)", (id_, path, version))
+    if len(self.rows) >= kInsertBatchSize:
+      self._flush_rows()
+
+  # Removes a comment and all of its postings.
+  def delete(self, id_):
+    self._flush_rows()
+    r = self.c.execute("SELECT json FROM comments WHERE comment_id=?", (id_,)).fetchone()
+    if r is None:
+      return
+    comment = json.loads(r[0])
+    rows = postings(id_, comment['tokens'].split(' '), comment['score'], self.hashfn)
+    if self.blocks:
+      for r in rows:
+        self.changes[r] = False
+      if len(self.changes) >= kInsertBatchSize:
+        self._flush_changes()
+    else:
+      self.c.executemany("""
+        DELETE FROM tokens
+        WHERE token_hash=? AND comment_score=? AND comment_id=?""", rows)
+    if self.maintain_stats:
+      self.c.executemany("UPDATE token_stats SET doc_freq=doc_freq-1 WHERE token_hash=?", [(r[0],) for r in rows])
+    if self.time_order:
+      self.c.executemany("""
+        DELETE FROM time_tokens
+        WHERE token_hash=? AND created_utc=? AND comment_id=?""",
+        time_postings(id_, comment['tokens'].split(' '), comment['created_utc'], self.hashfn))
+    self.c.execute("DELETE FROM comments WHERE comment_id=?", (id_,))
+    self.c.execute("DELETE FROM comment_attrs WHERE comment_id=?", (id_,))
+    self.c.execute("DELETE FROM versions WHERE comment_id=?", (id_,))
+
+  def files(self):
+    return {
+      path: (mtime, size, sha1)
+      for path, mtime, size, sha1 in self.c.execute("SELECT path, mtime, size, sha1 FROM files")
+    }
+
+  def set_file(self, path, mtime, size, sha1):
+    self.c.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (path, mtime, size, sha1))
+
+  def remove_file(self, path):
+    for id_ in self.comments_in(path):
+      self.delete(id_)
+    self.c.execute("DELETE FROM files WHERE path=?", (path,))
+
+  # Returns {comment_id: version} for the comments indexed from `path`.
+  def comments_in(self, path):
+    return dict(self.c.execute("SELECT comment_id, version FROM versions WHERE path=?", (path,)).fetchall())
+
+  # Returns the thread file a comment was indexed from (or None).
+  def owner(self, id_):
+    r = self.c.execute("SELECT path FROM versions WHERE comment_id=?", (id_,)).fetchone()
+    return None if r is None else r[0]
+
+  def create_indices(self):
+    self._flush()
+    ensure_indices(self.c)
+    ensure_token_stats(self.c)
+    self.maintain_stats = True
+    if self.packed and not self.blocks:
+      pack_postings(self.c)
+      self.blocks = True
+      self.repacked = True
+
+  def commit(self):
+    self._flush()
+    bump_version(self.c)
+    self.conn.commit()
+    if self.repacked:
+      # Give back the pages "tokens" used.
+      self.c.execute("VACUUM")
+      self.repacked = False
+    hot = load_hot_lists(hot_path(self.path))
+    if hot is not None:
+      build_hot_lists(self.c, hot_path(self.path), hot.top)
+
+if __name__ == '__main__':
+  argparser = argparse.ArgumentParser()
+  argparser.add_argument('path', help='sqlite index, e.g. new.db')
+  argparser.add_argument('--rehash', metavar='SCHEME', help='migrate the index to this token hash scheme')
+  argparser.add_argument('--pack', action='store_true', help='store postings as compressed blocks')
+  argparser.add_argument('--unpack', action='store_true', help='store postings as one row each')
+  argparser.add_argument('--time-order', action='store_true', help='also index postings by time, for newest/oldest-first results')
+  argparser.add_argument('--hot', type=int, metavar='N', help=f'memory-map the N most frequent tokens\' postings (e.g. {kHotListSize}; 0 removes them)')
+  args = argparser.parse_args()
+
+  conn = sqlite3.connect(args.path)
+  c = conn.cursor()
+  create_tables(c)
+  ensure_attributes(c)
+  conn.commit()
+  print('hash scheme:', hash_scheme(c))
+  print('postings:', posting_format(c))
+  # Whether the index changed, so the version is bumped (and any hot lists
+  # rebuilt) for readers.
+  changed = False
+  if args.rehash is not None and args.rehash != hash_scheme(c):
+    rehash(c, args.rehash)
+    conn.commit()
+    changed = True
+    print('rehashed to', args.rehash)
+  if args.pack and posting_format(c) != 'blocks':
+    pack_postings(c)
+    conn.commit()
+    c.execute("VACUUM")
+    changed = True
+    print('packed')
+  elif args.unpack and posting_format(c) == 'blocks':
+    unpack_postings(c)
+    ensure_indices(c)
+    conn.commit()
+    changed = True
+    print('unpacked')
+  if args.time_order and not has_time_order(c):
+    build_time_order(c)
+    conn.commit()
+    changed = True
+    print('built time_tokens')
+  if changed or args.hot is not None:
+    bump_version(c)
+    conn.commit()
+    print('index version:', index_version(c))
+  if args.hot == 0:
+    if os.path.exists(hot_path(args.path)):
+      os.remove(hot_path(args.path))
+  elif args.hot is not None or (changed and os.path.exists(hot_path(args.path))):
+    top = args.hot if args.hot is not None else load_hot_lists(hot_path(args.path)).top
+    build_hot_lists(c, hot_path(args.path), top)
+    conn.commit()
+    print(f'wrote the {top} most frequent tokens to', hot_path(args.path))
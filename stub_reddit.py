@@ -0,0 +1,288 @@
+"""
+A local stand-in for the parts of the reddit API refresh.py uses, serving
+synthetic threads, so the crawler can be exercised without credentials or
+network access.  Usage:
+
+  python3 stub_reddit.py [--comments N] [--drop P]   # self-check
+  python3 stub_reddit.py --crawl [--threads N] [--workers W]
+  python3 stub_reddit.py --serve PORT                 # just serve
+
+The self-check starts the server, crawls a thread with refresh.Submission
+and checks every comment was found, and that reddit's rule of one
+morechildren request at a time was never broken.  With --crawl it runs
+refresh.crawl over several threads with several crawl workers (in a
+temporary directory) and checks the same things.
+
+Threads behave like reddit's: the listing shows the first few comments of
+each subtree and "more" stubs listing every hidden descendant, and
+/api/morechildren returns the requested comments.  Like reddit it rejects a
+morechildren request while another is in flight (with an error in the JSON
+body), and --drop makes it silently leave out that fraction of the
+requested comments, differently for each sort order.
+"""
+
+import argparse, hashlib, json, os, random, tempfile, threading, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+kSubreddit = 'stub'
+kShownTopLevel = 20  # Top-level comments the listing shows.
+kShownDepth = 2      # Levels of replies the listing shows.
+
+class StubThread:
+  def __init__(self, id_, num_comments, created_utc, rng):
+    self.id = id_
+    self.created_utc = created_utc
+    self.ids = [f'{id_}c{i}' for i in range(num_comments)]
+    self.parent = {}
+    for i, c in enumerate(self.ids):
+      top = i < 2 * kShownTopLevel or rng.random() < 0.2
+      self.parent[c] = id_ if top else self.ids[rng.randrange(i)]
+    self.children = {}
+    for c in self.ids:
+      self.children.setdefault(self.parent[c], []).append(c)
+
+  def descendants(self, c):
+    R = []
+    stack = list(reversed(self.children.get(c, [])))
+    while len(stack):
+      c = stack.pop()
+      R.append(c)
+      stack += reversed(self.children.get(c, []))
+    return R
+
+  def fullname(self, c):
+    return ('t3_' if c == self.id else 't1_') + c
+
+  def comment(self, c):
+    i = int(c[len(self.id) + 1:])
+    return {'kind': 't1', 'data': {
+      'id': c,
+      'parent_id': self.fullname(self.parent[c]),
+      'link_id': 't3_' + self.id,
+      'created_utc': self.created_utc + i,
+      'score': 1,
+      'body': c,
+    }}
+
+  def more(self, parent, children):
+    return {'kind': 'more', 'data': {
+      'id': 'm' + parent,
+      'parent_id': self.fullname(parent),
+      'children': children,
+      'count': len(children),
+    }}
+
+  def json(self):
+    return {
+      'id': self.id,
+      'subreddit': kSubreddit,
+      'created_utc': self.created_utc,
+      'num_comments': len(self.ids),
+      'permalink': f'/r/{kSubreddit}/comments/{self.id}/',
+    }
+
+  def listing(self, order):
+    def build(c, depth):
+      j = self.comment(c)
+      kids = self.children.get(c, [])
+      if len(kids) > 0:
+        shown = kids[:1] if depth < kShownDepth else []
+        L = [build(k, depth + 1) for k in shown]
+        hidden = [x for k in kids[len(shown):] for x in [k] + self.descendants(k)]
+        if len(hidden):
+          L.append(self.more(c, hidden))
+        j['data']['replies'] = {'kind': 'Listing', 'data': {'children': L}}
+      return j
+    top = sorted(self.children.get(self.id, []), key=lambda c: order_key(c, order))
+    L = [build(c, 0) for c in top[:kShownTopLevel]]
+    hidden = [x for c in top[kShownTopLevel:] for x in [c] + self.descendants(c)]
+    if len(hidden):
+      L.append(self.more(self.id, hidden))
+    return [
+      {'kind': 'Listing', 'data': {'children': [{'kind': 't3', 'data': self.json()}]}},
+      {'kind': 'Listing', 'data': {'children': L}},
+    ]
+
+def order_key(c, order):
+  return hashlib.md5((c + order).encode()).hexdigest()
+
+class StubReddit:
+  def __init__(self, threads, drop=0., latency=0.):
+    self.threads = {t.id: t for t in threads}
+    self.drop = drop
+    self.latency = latency
+    self.lock = threading.Lock()
+    self.stats = {
+      'requests': 0,
+      'morechildren': 0,
+      'morechildren_ids': 0,
+      'morechildren_rejected': 0,
+      'max_morechildren_in_flight': 0,
+    }
+    self.morechildren_in_flight = 0
+
+  def dropped(self, c, order):
+    return int(order_key(c, order), 16) % 1000 < self.drop * 1000
+
+  def morechildren(self, q):
+    thread = self.threads[q['link_id'][0][3:]]
+    order = q.get('order', q.get('sort', ['confidence']))[0]
+    ids = q['children'][0].split(',')
+    with self.lock:
+      self.morechildren_in_flight += 1
+      busy = self.morechildren_in_flight > 1
+      self.stats['morechildren'] += 1
+      self.stats['max_morechildren_in_flight'] = max(self.stats['max_morechildren_in_flight'], self.morechildren_in_flight)
+      if busy:
+        self.stats['morechildren_rejected'] += 1
+      else:
+        self.stats['morechildren_ids'] += len(ids)
+    try:
+      time.sleep(self.latency)
+      if busy:
+        return {'json': {'errors': [['TOO_MANY_REQUESTS', 'one morechildren request at a time', None]]}}
+      things = [thread.comment(c) for c in ids if c in thread.parent and not self.dropped(c, order)]
+      return {'json': {'errors': [], 'data': {'things': things}}}
+    finally:
+      with self.lock:
+        self.morechildren_in_flight -= 1
+
+  def get(self, path, q):
+    with self.lock:
+      self.stats['requests'] += 1
+    if path == '/api/morechildren':
+      return self.morechildren(q)
+    time.sleep(self.latency)
+    if path.startswith('/r/'):
+      L = [] if 'after' in q else [
+        {'kind': 't3', 'data': t.json()}
+        for t in sorted(self.threads.values(), key=lambda t: -t.created_utc)
+      ]
+      return {'kind': 'Listing', 'data': {'children': L}}
+    if path.startswith('/comments/'):
+      id_ = path.split('/')[2].split('.')[0]
+      return self.threads[id_].listing(q.get('sort', ['confidence'])[0])
+    return None
+
+  def handler(self):
+    stub = self
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      def log_message(self, *args):
+        pass
+      def send(self, obj, code=200):
+        data = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+      def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send({'access_token': 'stub', 'expires_in': 3600})
+      def do_GET(self):
+        url = urlparse(self.path)
+        R = stub.get(url.path, parse_qs(url.query))
+        if R is None:
+          self.send({'error': 404}, 404)
+        else:
+          self.send(R)
+    return Handler
+
+  # Serves on a background thread; returns the server (see base_url).
+  def start(self, port=0):
+    server = ThreadingHTTPServer(('127.0.0.1', port), self.handler())
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def make_threads(sizes, seed=0):
+  rng = random.Random(seed)
+  now = time.time()
+  return [StubThread(f's{i}', n, now - 3600 * (i + 1), rng) for i, n in enumerate(sizes)]
+
+def base_url(server):
+  return f'http://127.0.0.1:{server.server_address[1]}'
+
+# A refresh.Reddit that talks to `server`.
+def stub_client(server):
+  import refresh
+  with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+    json.dump({'appid': 'stub', 'appsecret': 'stub', 'useragent': 'stub', 'username': 'stub', 'password': 'stub'}, f)
+  try:
+    reddit = refresh.Reddit(f.name, api_base=base_url(server), auth_url=base_url(server) + '/api/v1/access_token')
+  finally:
+    os.remove(f.name)
+  reddit.limiter = refresh.RateLimiter(rate=1000, capacity=100)
+  return reddit
+
+def check_submission(num_comments, drop):
+  import refresh
+  refresh.VERBOSITY = 0
+  stub = StubReddit(make_threads([num_comments]), drop=drop)
+  server = stub.start()
+  reddit = stub_client(server)
+  start = time.time()
+  submission = refresh.Submission(reddit, 's0', 'new')
+  submission.complete(refresh.kExtraOrders)
+  elapsed = time.time() - start
+  server.shutdown()
+  found = len(submission.comments)
+  print(f'{found} of {num_comments} comments in {elapsed:.2f}s; {submission.num_requests} requests; server: {json.dumps(stub.stats)}')
+  assert stub.stats['max_morechildren_in_flight'] == 1, 'concurrent morechildren requests'
+  if drop == 0:
+    assert found == num_comments, 'missing comments'
+
+def check_crawl(num_threads, num_comments, workers, latency):
+  import refresh
+  from crawlstate import CrawlState
+  refresh.VERBOSITY = 0
+  stub = StubReddit(make_threads([num_comments] * num_threads), latency=latency)
+  server = stub.start()
+  reddit = stub_client(server)
+  cwd = os.getcwd()
+  with tempfile.TemporaryDirectory() as tmp:
+    os.chdir(tmp)
+    try:
+      state = CrawlState('crawl.db')
+      start = time.time()
+      actions = refresh.crawl(reddit, state, [(kSubreddit, 1)], workers=workers)
+      elapsed = time.time() - start
+      counts = []
+      for thread in stub.threads.values():
+        with open(refresh.thread_path(thread.json())) as f:
+          counts.append(len(json.load(f)['comments']))
+      assert len(state.jobs()) == 0, 'unfinished jobs'
+    finally:
+      os.chdir(cwd)
+  server.shutdown()
+  print(f'{actions[refresh.kFull]} threads ({sum(counts)} comments) with {workers} workers in {elapsed:.2f}s; server: {json.dumps(stub.stats)}')
+  assert stub.stats['max_morechildren_in_flight'] == 1, 'concurrent morechildren requests'
+  assert counts == [num_comments] * num_threads, 'missing comments'
+
+if __name__ == '__main__':
+  argparser = argparse.ArgumentParser()
+  argparser.add_argument('--serve', type=int, metavar='PORT', help='serve until interrupted instead of running the self-check')
+  argparser.add_argument('--crawl', action='store_true', help='check refresh.crawl over several threads')
+  argparser.add_argument('--comments', type=int, default=2000, help='comments per thread')
+  argparser.add_argument('--threads', type=int, default=None, help='threads to serve (default 1, or 8 with --crawl)')
+  argparser.add_argument('--workers', type=int, default=4, help='crawl workers (with --crawl)')
+  argparser.add_argument('--drop', type=float, default=0., help='fraction of morechildren ids to leave out')
+  argparser.add_argument('--latency', type=float, default=None, help='seconds added to every request (default 0, or 0.02 with --crawl)')
+  args = argparser.parse_args()
+
+  if args.serve is not None:
+    stub = StubReddit(make_threads([args.comments] * (args.threads or 1)), drop=args.drop, latency=args.latency or 0.)
+    server = stub.start(args.serve)
+    print('serving on', base_url(server))
+    try:
+      while True:
+        time.sleep(3600)
+    except KeyboardInterrupt:
+      pass
+  elif args.crawl:
+    latency = 0.02 if args.latency is None else args.latency
+    check_crawl(args.threads or 8, args.comments, args.workers, latency)
+  else:
+    check_submission(args.comments, args.drop)
@@ -1,4 +1,4 @@
-import argparse, array, hashlib, json, os, random, re, shutil, sqlite3
+import argparse, array, functools, hashlib, json, os, random, re, shutil, sqlite3
 from datetime import datetime
 from html.parser import HTMLParser
 from urllib.parse import urlparse
@@ -7,13 +7,34 @@ pjoin = os.path.join
 def pad(t, n, c=' '):
   return max(n - len(t), 0) * c + t
 
+# The original token hash: the low 64 bits of sha256, offset into the
+# signed range sqlite stores.  Indexes built before "blake2b" use this.
+def sha256_hash64(x):
+  h = hashlib.sha256()
+  h.update(x.encode())
+  return int(h.hexdigest()[-16:], 16) - (1<<63)
+
+# A 64-bit blake2b digest is several times cheaper and is already a
+# signed 64-bit integer.
+def blake2b_hash64(x):
+  return int.from_bytes(hashlib.blake2b(x.encode(), digest_size=8).digest(), 'little', signed=True)
+
+kHashSchemes = {
+  'sha256': sha256_hash64,
+  'blake2b': blake2b_hash64,
+}
+kDefaultHashScheme = 'blake2b'
+
+# Tokens like "year:2020" and "sub:themotte" repeat constantly, so hashes
+# are memoized (boundedly, since the long tail of words is huge).
+kHashMemoSize = 1 << 16
+
 class Hash64:
-  def __init__(self):
-    pass
+  def __init__(self, scheme=kDefaultHashScheme, memo_size=kHashMemoSize):
+    self.scheme = scheme
+    self.hash = functools.lru_cache(maxsize=memo_size)(kHashSchemes[scheme])
   def __call__(self, x):
-    h = hashlib.sha256()
-    h.update(x.encode())
-    return int(h.hexdigest()[-16:], 16) - (1<<63)
+    return self.hash(x)
 hashfn = Hash64()
 
 kSecsPerDay = 60 * 60 * 24  # 86,400
@@ -30,43 +51,96 @@ class MyHTMLParser(HTMLParser):
   def reset(self):
     super().reset()
     self.blockquote = 0
-    self.text = ''
-    self.alltext = '' # Includes quoted text.
+    self.textparts = []
+    self.allparts = []
     self.links = set()
+  @property
+  def text(self):
+    return ''.join(self.textparts)
+  @property
+  def alltext(self):
+    # Includes quoted text.
+    return ''.join(self.allparts)
   def handle_starttag(self, tag, attrs):
     if tag == 'blockquote':
-      self.alltext += '<quote>'
+      self.allparts.append('<quote>')
       self.blockquote += 1
     elif tag == 'a':
-      self.alltext += '<a>'
+      self.allparts.append('<a>')
       href = [x for x in attrs if x[0] == 'href']
       self.links.add(href[0][1])
   def handle_endtag(self, tag):
     if tag == 'blockquote':
-      self.alltext += '</quote>'
+      self.allparts.append('</quote>')
       self.blockquote -= 1
     elif tag == 'a':
-      self.alltext += '</a>'
+      self.allparts.append('</a>')
   def handle_data(self, data):
     isUrl = bool(re.match(kUrlRegex, data))
-    self.alltext += data
+    self.allparts.append(data)
     if (self.blockquote == 0 or self.ignore_quotes) and not isUrl:
-      self.text += data
+      self.textparts.append(data)
 
-def threads(years=None):
+# Paths of all saved threads, in a stable order.
+def thread_paths(years=None):
   base = 'comments'
   if years is None:
     years = os.listdir(base)
-  for year in years:
+  for year in sorted(years):
     if not year.isdigit():
       continue
-    for fn in os.listdir(pjoin(base, year)):
+    for fn in sorted(os.listdir(pjoin(base, year))):
       if fn[-5:] != '.json':
         continue
-      path = pjoin(base, year, fn)
-      with open(pjoin(base, year, fn), 'r') as f:
-        J = json.load(f)
-      yield J
+      yield pjoin(base, year, fn)
+
+def threads(years=None):
+  for path in thread_paths(years):
+    with open(path, 'r') as f:
+      J = json.load(f)
+    yield J
+
+"""
+The reply structure of a thread, computed in one pass over its comments.
+
+Comments whose parent isn't in the thread (top-level comments, or replies
+to comments we never fetched) are roots at depth 0.
+"""
+class ThreadTree:
+  def __init__(self, comments):
+    self.id2comment = {}
+    for comment in comments:
+      self.id2comment[comment['id']] = comment
+
+    self.parent = {}
+    self.children = {id_: [] for id_ in self.id2comment}
+    for id_, comment in self.id2comment.items():
+      pid = comment['parent_id'][3:]
+      if pid in self.id2comment and pid != id_:
+        self.parent[id_] = pid
+        self.children[pid].append(id_)
+    self.roots = [id_ for id_ in self.id2comment if id_ not in self.parent]
+
+    # Breadth-first from the roots, so parents come before their children.
+    self.depth = {id_: 0 for id_ in self.roots}
+    self.order = list(self.roots)
+    for id_ in self.order:
+      for child in self.children[id_]:
+        self.depth[child] = self.depth[id_] + 1
+        self.order.append(child)
+
+    # Number of comments in each comment's subtree (including itself).
+    self.subtree_size = {}
+    for id_ in reversed(self.order):
+      self.subtree_size[id_] = 1 + sum(self.subtree_size[child] for child in self.children[id_])
+
+  def get_parent(self, id_):
+    pid = self.parent.get(id_, None)
+    return None if pid is None else self.id2comment[pid]
+
+  def get_gparent(self, id_):
+    pid = self.parent.get(id_, None)
+    return None if pid is None else self.get_parent(pid)
 
 parser = MyHTMLParser()
 
@@ -76,27 +150,72 @@ def getscore(comment):
 """
 TODO: "i.e." should become "i.e."
 """
+kTokenRegex = re.compile(r"[\w%@#$^&']+")
+
 def text2tokens(text):
-  text = text.lower()
-  text = re.sub(r"[^\w\d%@#$^&']+", " ", text)
-  text = ' ' + text + ' '
-  text = text.replace(" '", " ")
-  text = text.replace("' ", " ")
-  tokens = set(text.strip().split(' '))
-  if '' in tokens:
-    tokens.remove('')
-  for token in kTokenBlacklist:
-    if token in tokens:
-      tokens.remove(token)
+  tokens = set(kTokenRegex.findall(text.lower()))
+  # Quotes aren't part of words: strip one leading and one trailing
+  # apostrophe ("'foo'" -> "foo", but "you're" and "dogs'" -> "dogs").
+  quoted = [t for t in tokens if t[0] == "'" or t[-1] == "'"]
+  tokens.difference_update(quoted)
+  for token in quoted:
+    if token[0] == "'":
+      token = token[1:]
+    if token[-1:] == "'":
+      token = token[:-1]
+    tokens.add(token)
+  tokens.discard('')
+  tokens -= kTokenBlacklist
   return tokens
 
+# Local year and month of a timestamp.  Every timezone offset is a multiple
+# of 15 minutes, so all timestamps in a 15 minute bucket share a month.
+@functools.lru_cache(maxsize=1 << 14)
+def _year_month(bucket):
+  date = datetime.fromtimestamp(bucket * 900)
+  return date.year, date.month
+
+def year_month(timestamp):
+  return _year_month(int(timestamp // 900))
+
+@functools.lru_cache(maxsize=1 << 14)
+def link_domain(link):
+  loc = urlparse(link).netloc
+  if loc[:4] == 'www.':
+    loc = loc[4:]
+  elif loc[:3] == 'en.':
+    loc = loc[3:]
+  return loc
+
+def subreddit_name(thread):
+  s = thread["subreddit"]
+  if s[:2] == 'r/':
+    s = s[2:]
+  if s == 't5_30m6u':
+    s = 'slatestarcodex'
+  elif s == 't5_vkedk':
+    s = 'TheMotte'
+  return s
+
+# Display fields that don't depend on the query, so the server doesn't have
+# to recompute them for every result.  `alltext` is the comment's body_html
+# as normalized by MyHTMLParser (get_tokens leaves it in `parser.alltext`).
+def display_fields(comment, parent, thread, alltext):
+  R = {"body_render": alltext}
+  if parent and 'author' in parent:
+    R["pauthor"] = parent["author"].lower()
+  if thread:
+    R["subreddit"] = subreddit_name(thread)
+  else:
+    R["subreddit"] = 'slatestarcodex' if 'slatestarcodex' in comment['permalink'] else 'TheMotte'
+  return R
+
 def get_tokens(comment, parent, gparent, thread, isthread):
   parser.reset()
   parser.feed(comment['body_html'])
   parser.close()
 
   links = parser.links
-  alltext = parser.alltext
   if thread:
     iscw = ('culture_war_roundup' in thread['url'])
 
@@ -108,9 +227,9 @@ def get_tokens(comment, parent, gparent, thread, isthread):
   if 'author' in comment:
     tokens.add(f'author:{comment["author"].lower()}')
 
-  date = datetime.fromtimestamp(comment['created_utc'])
-  tokens.add(f'year:{date.year}')
-  tokens.add(f'month:{date.month}')
+  year, month = year_month(comment['created_utc'])
+  tokens.add(f'year:{year}')
+  tokens.add(f'month:{month}')
 
   # Add CW indicator
   if thread:
@@ -122,23 +241,9 @@ def get_tokens(comment, parent, gparent, thread, isthread):
 
   tokens.add(f'score:{getscore(comment)}')
   if thread:
-    s = thread["subreddit"]
-    if s[:2] == 'r/':
-      s = s[2:]
-    if s == 't5_30m6u':
-      s = 'slatestarcodex'
-    elif s == 't5_vkedk':
-      s = 'TheMotte'
-    tokens.add(f'sub:{s.lower()}')
-
-  domains = set()
-  for link in parser.links:
-    loc = urlparse(link).netloc
-    if loc[:4] == 'www.':
-      loc = loc[4:]
-    elif loc[:3] == 'en.':
-      loc = loc[3:]
-    domains.add(loc)
+    tokens.add(f'sub:{subreddit_name(thread).lower()}')
+
+  domains = set(link_domain(link) for link in parser.links)
   for domain in domains:
     tokens.add(f'linksto:{domain}')
   